@@ -15,6 +15,35 @@ import re  # Added for phone validation
 import requests
 import uuid
 import json
+from contextlib import contextmanager
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from functools import lru_cache
+import io
+import tempfile
+import time
+
+# QR-коды чеков рисуются локально, если установлен qrcode (с Pillow)
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+# Расчёт выплат векторизуется через NumPy, если он установлен
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# XLSX-выгрузка доступна, если установлен openpyxl; иначе только CSV
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
 
 # Безопасная загрузка минимального холда
 try:
@@ -22,6 +51,8 @@ try:
 except Exception:
     MIN_HOLD_MINUTES = 54
 
+tz = pytz.timezone('Europe/Moscow')
+
 def adapt_datetime(dt):
     return dt.isoformat()
 
@@ -36,262 +67,696 @@ sqlite3.register_converter("DATETIME", convert_datetime)
 
 bot = telebot.TeleBot(config.BOT_TOKEN)
 
-conn = sqlite3.connect('bot.db', check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
-cursor = conn.cursor()
-
-# Initialize database tables
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY,
-    username TEXT,
-    reputation REAL DEFAULT 10.0,
-    balance REAL DEFAULT 0.0,
-    subscription_type TEXT,
-    subscription_end DATETIME,
-    referral_code TEXT,
-    referrals_count INTEGER DEFAULT 0,
-    profit_level TEXT DEFAULT 'новичок',
-    card_number TEXT,
-    cvv TEXT,
-    card_balance REAL DEFAULT 0.0,
-    card_status TEXT DEFAULT 'inactive',
-    card_password TEXT,
-    card_activation_date DATETIME,
-    phone_number TEXT,
-    last_activity DATETIME,
-    api_token TEXT,
-    block_reason TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS admins (
-    id INTEGER PRIMARY KEY
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS queue (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT UNIQUE,
-    added_time DATETIME,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS working (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT UNIQUE,
-    start_time DATETIME,
-    admin_id INTEGER,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS successful (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT,
-    hold_time TEXT,
-    acceptance_time DATETIME,
-    flight_time DATETIME,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS blocked (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    phone_number TEXT,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS referrals (
-    referer_id INTEGER,
-    referee_id INTEGER,
-    PRIMARY KEY (referer_id, referee_id)
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS withdraw_requests (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    amount REAL,
-    status TEXT DEFAULT 'pending',
-    created_at DATETIME,
-    paid_at DATETIME
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS deposit_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    amount REAL NOT NULL,
-    created_at DATETIME NOT NULL,
-    request_id INTEGER NOT NULL,
-    FOREIGN KEY (user_id) REFERENCES users (id)
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    action TEXT,
-    timestamp DATETIME
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS admin_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    admin_id INTEGER,
-    action TEXT,
-    timestamp DATETIME
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS status (
-    key TEXT PRIMARY KEY,
-    value TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS card_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    amount REAL,
-    timestamp DATETIME,
-    type TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS transfers (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    from_user_id INTEGER,
-    to_user_id INTEGER,
-    amount REAL,
-    timestamp DATETIME
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS payments (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    sub_type TEXT,
-    amount REAL,
-    invoice_id TEXT,
-    payload TEXT,
-    status TEXT DEFAULT 'pending',
-    transaction_id TEXT
-)
-''')
-
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS checks (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    creator_id INTEGER,
-    amount REAL,
-    unique_code TEXT UNIQUE,
-    description TEXT,
-    password TEXT,
-    image_file_id TEXT,
-    require_subs TEXT,
-    require_premium INTEGER DEFAULT 0,
-    activated_by INTEGER,
-    activated_at DATETIME
-)
-''')
-
-# Add columns if missing
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN unique_code TEXT UNIQUE")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+DB_PATH = 'bot.db'
 
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN description TEXT")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+# Доступ к БД: у каждого потока своё соединение (WAL даёт параллельное чтение),
+# а все записи проходят через один замок, так что пишет всегда один поток.
+# Чтения идут в autocommit — каждая выборка это короткая читающая транзакция.
+_db_local = threading.local()
+_db_write_lock = threading.RLock()
 
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN password TEXT")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+def _db_connect():
+    c = sqlite3.connect(DB_PATH, timeout=30, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA busy_timeout=30000")
+    return c
 
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN image_file_id TEXT")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+def get_conn():
+    c = getattr(_db_local, 'conn', None)
+    if c is None:
+        c = _db_local.conn = _db_connect()
+    return c
 
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN require_subs TEXT")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+def db_fetchone(sql, params=()):
+    return get_conn().execute(sql, params).fetchone()
 
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN require_premium INTEGER DEFAULT 0")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+def db_fetchall(sql, params=()):
+    return get_conn().execute(sql, params).fetchall()
 
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN activated_by INTEGER")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+def db_fetchone_dict(sql, params=()):
+    cur = get_conn().execute(sql, params)
+    row = cur.fetchone()
+    if row:
+        columns = [desc[0] for desc in cur.description]
+        return dict(zip(columns, row))
+    return None
 
-try:
-    cursor.execute("ALTER TABLE checks ADD COLUMN activated_at DATETIME")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+def db_fetchall_dicts(sql, params=()):
+    cur = get_conn().execute(sql, params)
+    rows = cur.fetchall()
+    columns = [desc[0] for desc in cur.description]
+    return [dict(zip(columns, row)) for row in rows]
 
-try:
-    cursor.execute("ALTER TABLE payments ADD COLUMN payload TEXT")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+@contextmanager
+def db_transaction():
+    # Вложенный вызов присоединяется к внешней транзакции
+    with _db_write_lock:
+        c = get_conn()
+        depth = getattr(_db_local, 'depth', 0)
+        if depth:
+            _db_local.depth = depth + 1
+            try:
+                yield c
+            finally:
+                _db_local.depth = depth
+            return
+        c.execute("BEGIN IMMEDIATE")
+        _db_local.depth = 1
+        _db_local.after_commit = []
+        try:
+            yield c
+            c.execute("COMMIT")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            _db_local.depth = 0
+            callbacks, _db_local.after_commit = _db_local.after_commit, []
+    for callback in callbacks:
+        callback()
+
+def db_after_commit(callback):
+    # Колбэк выполнится после фиксации текущей транзакции (или сразу, если её нет)
+    if getattr(_db_local, 'depth', 0):
+        _db_local.after_commit.append(callback)
+    else:
+        callback()
 
-try:
-    cursor.execute("ALTER TABLE withdraw_requests ADD COLUMN created_at DATETIME")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+def db_execute(sql, params=()):
+    with db_transaction() as c:
+        return c.execute(sql, params)
 
-try:
-    cursor.execute("ALTER TABLE withdraw_requests ADD COLUMN paid_at DATETIME")
-    conn.commit()
-except sqlite3.OperationalError:
-    pass
+# Схема БД: каждая миграция выполняется один раз, номер применённой версии
+# хранится в PRAGMA user_version. Если схема актуальна, старт — одно чтение прагмы.
+SCHEMA_MIGRATIONS = []
 
-cursor.execute("INSERT OR IGNORE INTO status (key, value) VALUES ('work_status', 'Full work 🟢')")
-conn.commit()
+def migration(version):
+    def decorator(func):
+        SCHEMA_MIGRATIONS.append((version, func))
+        return func
+    return decorator
+
+def _table_columns(c, table):
+    return {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+
+def _add_column(c, table, column, decl):
+    if column in _table_columns(c, table):
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+@migration(1)
+def _migration_base_schema(c):
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        reputation REAL DEFAULT 10.0,
+        balance REAL DEFAULT 0.0,
+        subscription_type TEXT,
+        subscription_end DATETIME,
+        referral_code TEXT,
+        referrals_count INTEGER DEFAULT 0,
+        profit_level TEXT DEFAULT 'новичок',
+        card_number TEXT,
+        cvv TEXT,
+        card_balance REAL DEFAULT 0.0,
+        card_status TEXT DEFAULT 'inactive',
+        card_password TEXT,
+        card_activation_date DATETIME,
+        phone_number TEXT,
+        last_activity DATETIME,
+        api_token TEXT,
+        block_reason TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS admins (
+        id INTEGER PRIMARY KEY
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone_number TEXT UNIQUE,
+        added_time DATETIME,
+        type TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS working (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone_number TEXT UNIQUE,
+        start_time DATETIME,
+        admin_id INTEGER,
+        type TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS successful (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone_number TEXT,
+        hold_time TEXT,
+        acceptance_time DATETIME,
+        flight_time DATETIME,
+        type TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS blocked (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone_number TEXT,
+        type TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS referrals (
+        referer_id INTEGER,
+        referee_id INTEGER,
+        PRIMARY KEY (referer_id, referee_id)
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS withdraw_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        status TEXT DEFAULT 'pending',
+        created_at DATETIME,
+        paid_at DATETIME
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS deposit_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        created_at DATETIME NOT NULL,
+        request_id INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action TEXT,
+        timestamp DATETIME
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS admin_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        action TEXT,
+        timestamp DATETIME
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS status (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS card_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        timestamp DATETIME,
+        type TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS transfers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_user_id INTEGER,
+        to_user_id INTEGER,
+        amount REAL,
+        timestamp DATETIME
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        sub_type TEXT,
+        amount REAL,
+        invoice_id TEXT,
+        payload TEXT,
+        status TEXT DEFAULT 'pending',
+        transaction_id TEXT
+    )
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS checks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        creator_id INTEGER,
+        amount REAL,
+        unique_code TEXT UNIQUE,
+        description TEXT,
+        password TEXT,
+        image_file_id TEXT,
+        require_subs TEXT,
+        require_premium INTEGER DEFAULT 0,
+        activated_by INTEGER,
+        activated_at DATETIME
+    )
+    ''')
+
+    # Базы, созданные старыми версиями бота, могут не иметь этих колонок
+    if _add_column(c, 'checks', 'unique_code', 'TEXT'):
+        # ADD COLUMN не умеет UNIQUE, поэтому уникальность — отдельным индексом
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_checks_unique_code ON checks (unique_code)")
+    _add_column(c, 'checks', 'description', 'TEXT')
+    _add_column(c, 'checks', 'password', 'TEXT')
+    _add_column(c, 'checks', 'image_file_id', 'TEXT')
+    _add_column(c, 'checks', 'require_subs', 'TEXT')
+    _add_column(c, 'checks', 'require_premium', 'INTEGER DEFAULT 0')
+    _add_column(c, 'checks', 'activated_by', 'INTEGER')
+    _add_column(c, 'checks', 'activated_at', 'DATETIME')
+    _add_column(c, 'payments', 'payload', 'TEXT')
+    _add_column(c, 'withdraw_requests', 'created_at', 'DATETIME')
+    _add_column(c, 'withdraw_requests', 'paid_at', 'DATETIME')
+
+    c.execute("INSERT OR IGNORE INTO status (key, value) VALUES ('work_status', 'Full work 🟢')")
+
+@migration(2)
+def _migration_hot_path_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_queue_user ON queue (user_id, added_time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_queue_added ON queue (added_time)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_working_user ON working (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_successful_user ON successful (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_blocked_user ON blocked (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_card_history_user ON card_history (user_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transfers_to ON transfers (to_user_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transfers_from ON transfers (from_user_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_withdraw_user_status ON withdraw_requests (user_id, status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_payload ON payments (payload)")
+
+@migration(3)
+def _migration_ledger_postings(c):
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS postings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        txn_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        account TEXT NOT NULL,
+        amount REAL NOT NULL,
+        kind TEXT,
+        created_at DATETIME NOT NULL
+    )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_postings_account ON postings (user_id, account, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_postings_txn ON postings (txn_id)")
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        user_id INTEGER NOT NULL,
+        account TEXT NOT NULL,
+        posting_id INTEGER NOT NULL,
+        balance REAL NOT NULL,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (user_id, account)
+    )
+    ''')
+    # Текущие остатки переносим в журнал вступительными проводками
+    now = datetime.now(tz)
+    for column in ('card_balance', 'balance'):
+        c.execute(f"INSERT INTO postings (txn_id, user_id, account, amount, kind, created_at) SELECT 'opening', id, '{column}', {column}, 'opening', ? FROM users WHERE {column} != 0", (now,))
+    c.execute("INSERT INTO postings (txn_id, user_id, account, amount, kind, created_at) SELECT 'opening', 0, 'opening', -SUM(amount), 'opening', ? FROM postings WHERE txn_id = 'opening' HAVING COUNT(*) > 0", (now,))
+
+@migration(4)
+def _migration_working_timers(c):
+    _add_column(c, 'working', 'status', "TEXT DEFAULT 'taken'")
+    _add_column(c, 'working', 'accepted_at', 'DATETIME')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS timers (
+        key TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT,
+        due_at REAL NOT NULL
+    )
+    ''')
+
+@migration(5)
+def _migration_sweeper_indexes(c):
+    if _add_column(c, 'payments', 'created_at', 'DATETIME'):
+        # Старым счетам отсчитываем срок с момента обновления
+        c.execute("UPDATE payments SET created_at = ? WHERE created_at IS NULL", (datetime.now(tz),))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_subscription_end ON users (subscription_end)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_card_block ON users (card_status, block_reason, card_activation_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at)")
+
+@migration(6)
+def _migration_multi_use_checks(c):
+    # amount — сумма одной активации, резерв чека — amount * activation_limit
+    _add_column(c, 'checks', 'activation_limit', 'INTEGER DEFAULT 1')
+    _add_column(c, 'checks', 'activations_count', 'INTEGER DEFAULT 0')
+    c.execute("UPDATE checks SET activations_count = 1 WHERE activated_at IS NOT NULL AND activations_count = 0")
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS check_activations (
+        check_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        activated_at DATETIME NOT NULL,
+        PRIMARY KEY (check_id, user_id)
+    )
+    ''')
+    c.execute("INSERT OR IGNORE INTO check_activations (check_id, user_id, amount, activated_at) SELECT id, activated_by, amount, activated_at FROM checks WHERE activated_by IS NOT NULL AND activated_at IS NOT NULL")
+
+@migration(7)
+def _migration_check_qr_file_id(c):
+    _add_column(c, 'checks', 'qr_file_id', 'TEXT')
+
+@migration(8)
+def _migration_successful_flight_index(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_successful_flight ON successful (flight_time)")
+
+@migration(9)
+def _migration_payroll_settlements(c):
+    # Тариф фиксируется в момент холда; для старых строк берём текущую подписку
+    if _add_column(c, 'successful', 'sub_type', 'TEXT'):
+        c.execute("UPDATE successful SET sub_type = (SELECT subscription_type FROM users WHERE users.id = successful.user_id)")
+    _add_column(c, 'successful', 'settlement_id', 'INTEGER')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS settlements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        period_start DATETIME NOT NULL,
+        period_end DATETIME NOT NULL,
+        holds_count INTEGER NOT NULL,
+        workers_count INTEGER NOT NULL,
+        total REAL NOT NULL,
+        created_at DATETIME NOT NULL
+    )
+    ''')
+
+# Гистограммы минут ограничены неделей: всё дольше попадает в последнюю корзину
+ROLLUP_MAX_BUCKET = 7 * 24 * 60
+
+@migration(10)
+def _migration_daily_rollups(c):
+    if _add_column(c, 'successful', 'hold_minutes', 'REAL'):
+        # julianday — дробные дни, разность чуть меньше точной (59.9999998 вместо 60):
+        # округляем до миллисекунд, иначе ломаются границы часов и корзин гистограммы
+        c.execute("UPDATE successful SET hold_minutes = ROUND((julianday(flight_time) - julianday(acceptance_time)) * 86400, 3) / 60.0 WHERE acceptance_time IS NOT NULL AND flight_time IS NOT NULL")
+    _add_column(c, 'working', 'queued_at', 'DATETIME')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        added INTEGER NOT NULL DEFAULT 0,
+        taken INTEGER NOT NULL DEFAULT 0,
+        successful INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        dropped INTEGER NOT NULL DEFAULT 0,
+        wait_minutes REAL NOT NULL DEFAULT 0,
+        hold_minutes REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id, type)
+    )
+    ''')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS daily_histograms (
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (day, metric, user_id, type, bucket)
+    )
+    ''')
+    # История: добавления из текущей очереди и успешные холды (у blocked нет времени)
+    c.execute('''
+    INSERT INTO daily_stats (day, user_id, type, added)
+    SELECT substr(added_time, 1, 10), user_id, COALESCE(type, ''), COUNT(*) FROM queue
+    WHERE added_time IS NOT NULL GROUP BY 1, 2, 3
+    ''')
+    c.execute('''
+    INSERT INTO daily_stats (day, user_id, type, successful, hold_minutes)
+    SELECT substr(flight_time, 1, 10), user_id, COALESCE(type, ''), COUNT(*), COALESCE(SUM(hold_minutes), 0) FROM successful
+    WHERE flight_time IS NOT NULL GROUP BY 1, 2, 3
+    ON CONFLICT (day, user_id, type) DO UPDATE SET successful = excluded.successful, hold_minutes = excluded.hold_minutes
+    ''')
+    c.execute(f'''
+    INSERT INTO daily_histograms (day, user_id, type, metric, bucket, count)
+    SELECT substr(flight_time, 1, 10), user_id, COALESCE(type, ''), 'hold', MIN(CAST(hold_minutes AS INTEGER), {ROLLUP_MAX_BUCKET}), COUNT(*) FROM successful
+    WHERE flight_time IS NOT NULL AND hold_minutes IS NOT NULL GROUP BY 1, 2, 3, 5
+    ''')
+
+# Все номера живут в одной таблице numbers, этап жизни — в колонке state:
+# queued → taken → code_requested → code_entered → accepted, а дальше
+# successful, blocked, dropped (снят в работе) или removed (удалён владельцем
+# из очереди). Переход — обновление одной строки, id номера не меняется.
+WORKING_STATES = ('taken', 'code_requested', 'code_entered', 'accepted')
+LIVE_STATES = ('queued',) + WORKING_STATES
+NUMBER_VIEWS = {
+    'queue': ('queued',),
+    'working': WORKING_STATES,
+    'successful': ('successful',),
+    'blocked': ('blocked',),
+}
+
+def normalize_phone(phone):
+    # Ключ для дублей: последние 10 цифр, +79991234567 и 9991234567 совпадают
+    return re.sub(r'\D', '', phone or '')[-10:]
+
+def _states_sql(states):
+    return ', '.join(f"'{state}'" for state in states)
+
+@migration(11)
+def _migration_numbers_registry(c):
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS numbers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        phone_number TEXT NOT NULL,
+        phone_key TEXT NOT NULL,
+        type TEXT,
+        state TEXT NOT NULL,
+        admin_id INTEGER,
+        added_time DATETIME,
+        start_time DATETIME,
+        accepted_at DATETIME,
+        flight_time DATETIME,
+        hold_time TEXT,
+        hold_minutes REAL,
+        sub_type TEXT,
+        settlement_id INTEGER
+    )
+    ''')
+    # Пока номер жив, второй такой же (того же типа) добавить нельзя
+    c.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_numbers_live_phone ON numbers (phone_key, type) WHERE state IN ({_states_sql(LIVE_STATES)})")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_numbers_user_state ON numbers (user_id, state)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_numbers_state_flight ON numbers (state, flight_time)")
+    c.create_function('normalize_phone', 1, normalize_phone, deterministic=True)
+    # Старая таблица различала +79991234567 и 9991234567: из таких дублей в
+    # работе остаётся строка с меньшим id, остальные переносятся снятыми
+    dropped = [row[0] for row in c.execute("""
+        SELECT w.id FROM working w WHERE EXISTS (
+            SELECT 1 FROM working k WHERE k.id < w.id AND k.type = w.type AND normalize_phone(k.phone_number) = normalize_phone(w.phone_number))""")]
+    # id номеров в работе сохраняются: на них ссылаются таймеры и кнопки операторов
+    c.execute("""
+        INSERT INTO numbers (id, user_id, phone_number, phone_key, type, state, admin_id, added_time, start_time, accepted_at)
+        SELECT id, user_id, phone_number, normalize_phone(phone_number), type,
+               CASE WHEN id IN (SELECT value FROM json_each(?)) THEN 'dropped' ELSE COALESCE(status, 'taken') END,
+               admin_id, queued_at, start_time, accepted_at FROM working""", (json.dumps(dropped),))
+    if dropped:
+        print(f"Migration 11: duplicate working numbers moved to 'dropped': {dropped}")
+    # Номер, который был и в очереди, и в работе, остаётся только в работе
+    c.execute("""
+        INSERT OR IGNORE INTO numbers (user_id, phone_number, phone_key, type, state, added_time)
+        SELECT user_id, phone_number, normalize_phone(phone_number), type, 'queued', added_time FROM queue ORDER BY id""")
+    c.execute("""
+        INSERT INTO numbers (user_id, phone_number, phone_key, type, state, accepted_at, flight_time, hold_time, hold_minutes, sub_type, settlement_id)
+        SELECT user_id, phone_number, normalize_phone(phone_number), type, 'successful', acceptance_time, flight_time, hold_time, hold_minutes, sub_type, settlement_id FROM successful ORDER BY id""")
+    c.execute("""
+        INSERT INTO numbers (user_id, phone_number, phone_key, type, state)
+        SELECT user_id, phone_number, normalize_phone(phone_number), type, 'blocked' FROM blocked ORDER BY id""")
+    for table in ('queue', 'working', 'successful', 'blocked'):
+        c.execute(f"DROP TABLE {table}")
+
+@migration(12)
+def _migration_paged_lists(c):
+    # Постраничная история зачислений идёт по (paid_at, id); у старых выплат даты нет
+    c.execute("UPDATE withdraw_requests SET paid_at = created_at WHERE status = 'paid' AND paid_at IS NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_withdraw_user_status_paid ON withdraw_requests (user_id, status, paid_at)")
+
+@migration(13)
+def _migration_worker_stats_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_daily_stats_user ON daily_stats (user_id, day)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_daily_histograms_user ON daily_histograms (user_id, metric, day)")
+
+@migration(14)
+def _migration_card_statements(c):
+    # Строки истории ссылаются на перевод и вторую сторону напрямую
+    linked = _add_column(c, 'card_history', 'transfer_id', 'INTEGER')
+    _add_column(c, 'card_history', 'counterparty_id', 'INTEGER')
+    if linked:
+        # Старые строки связываем так же, как их искал экран истории: по сумме и времени
+        c.execute("""
+            UPDATE card_history SET transfer_id = (
+                SELECT t.id FROM transfers t
+                WHERE t.to_user_id = card_history.user_id AND t.amount = card_history.amount AND t.timestamp = card_history.timestamp
+                ORDER BY t.id LIMIT 1)
+            WHERE type = 'transfer_in'""")
+        c.execute("""
+            UPDATE card_history SET transfer_id = (
+                SELECT t.id FROM transfers t
+                WHERE t.from_user_id = card_history.user_id AND t.amount = -card_history.amount AND t.timestamp = card_history.timestamp
+                ORDER BY t.id LIMIT 1)
+            WHERE type = 'transfer_out'""")
+        c.execute("""
+            UPDATE card_history SET counterparty_id = (
+                SELECT CASE WHEN card_history.type = 'transfer_in' THEN t.from_user_id ELSE t.to_user_id END
+                FROM transfers t WHERE t.id = card_history.transfer_id)
+            WHERE transfer_id IS NOT NULL""")
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS card_statements (
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        opening REAL NOT NULL,
+        credits REAL NOT NULL,
+        debits REAL NOT NULL,
+        closing REAL NOT NULL,
+        operations INTEGER NOT NULL,
+        by_type TEXT NOT NULL,
+        created_at DATETIME NOT NULL,
+        PRIMARY KEY (user_id, month)
+    )
+    ''')
+
+@migration(15)
+def _migration_statements_from_postings(c):
+    # Выписки строятся только по журналу проводок. Журнал начинается со
+    # вступительных проводок миграции 3 — раньше этой даты выписок нет.
+    started = c.execute("SELECT MIN(created_at) FROM postings WHERE txn_id = 'opening'").fetchone()[0] \
+        or c.execute("SELECT MIN(created_at) FROM postings").fetchone()[0] \
+        or datetime.now(tz).isoformat()
+    c.execute("INSERT OR IGNORE INTO status (key, value) VALUES ('ledger_started_at', ?)", (started,))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_postings_account_created ON postings (user_id, account, created_at)")
+    # Сохранённые ранее выписки смешивали журнал и card_history — пересчитаются по запросу
+    c.execute("DELETE FROM card_statements")
+
+@migration(16)
+def _migration_removed_rollup(c):
+    # Удалённые владельцем из очереди номера — отдельный счётчик сводки;
+    # история — по уже удалённым строкам numbers (время удаления в flight_time)
+    _add_column(c, 'daily_stats', 'removed', 'INTEGER NOT NULL DEFAULT 0')
+    c.execute('''
+    INSERT INTO daily_stats (day, user_id, type, removed)
+    SELECT substr(flight_time, 1, 10), user_id, COALESCE(type, ''), COUNT(*) FROM numbers
+    WHERE state = 'removed' AND flight_time IS NOT NULL AND user_id IS NOT NULL GROUP BY 1, 2, 3
+    ON CONFLICT (day, user_id, type) DO UPDATE SET removed = excluded.removed
+    ''')
+
+# Счёт ещё можно зачислить, пока он не оплачен: 'expired' ставит уборщик,
+# но инвойс у платёжки остаётся оплачиваемым и поздняя оплата не теряется
+PAYABLE_STATUSES = ('pending', 'expired')
+
+# Запросы горячих путей регистрируются рядом с хелперами, которые их
+# выполняют: hot_query возвращает тот же текст SQL, что дальше и исполняется.
+# tests/test_query_plans.py прогоняет их через EXPLAIN QUERY PLAN — ни один
+# не должен уходить в полный скан таблицы.
+HOT_QUERIES = []
+
+def hot_query(name, sql, params):
+    # params — образец параметров, с которым строится план
+    HOT_QUERIES.append((name, sql, tuple(params)))
+    return sql
+
+def find_full_scans():
+    # Отдельное соединение: кэш подготовленных запросов хранит старые планы после смены схемы
+    c = _db_connect()
+    offenders = []
+    try:
+        for name, sql, params in HOT_QUERIES:
+            plan = [row[3] for row in c.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            if any(step.startswith('SCAN ') for step in plan):
+                offenders.append((name, plan))
+    finally:
+        c.close()
+    return offenders
+
+def init_db():
+    target = max(version for version, _ in SCHEMA_MIGRATIONS)
+    if db_fetchone("PRAGMA user_version")[0] >= target:
+        return
+    with db_transaction() as c:
+        # Перечитываем под замком: другой процесс мог уже обновить схему
+        current = c.execute("PRAGMA user_version").fetchone()[0]
+        for version, func in sorted(SCHEMA_MIGRATIONS, key=lambda m: m[0]):
+            if version > current:
+                func(c)
+        if target > current:
+            c.execute(f"PRAGMA user_version = {target}")
+
+init_db()
+
+# Админы и username бота загружаются один раз при старте; проверки прав и
+# сборка ссылок дальше работают из памяти без запросов к БД и Telegram.
+_admin_ids = frozenset()
+
+def reload_admins():
+    global _admin_ids
+    _admin_ids = frozenset(row[0] for row in db_fetchall("SELECT id FROM admins"))
+
+def add_admin(user_id):
+    with db_transaction() as c:
+        c.execute("INSERT OR IGNORE INTO admins (id) VALUES (?)", (user_id,))
+        db_after_commit(reload_admins)
+
+def remove_admin(user_id):
+    with db_transaction() as c:
+        c.execute("DELETE FROM admins WHERE id = ?", (user_id,))
+        db_after_commit(reload_admins)
+
+reload_admins()
 
 # Add initial admin
-cursor.execute("INSERT OR IGNORE INTO admins (id) VALUES (?)", (config.ADMIN_IDS[0],))
-conn.commit()
+if config.ADMIN_IDS[0] not in _admin_ids:
+    add_admin(config.ADMIN_IDS[0])
+
+BOT_USERNAME = bot.get_me().username
 
-pending_activations = {}  # To store admin_id for pending activations
-pending_timers = {}  # To store timers for cancellation
+def bot_link(payload):
+    return f"https://t.me/{BOT_USERNAME}?start={payload}"
+
+# Уведомления, которые не должны задерживать обработчик (например, создателю
+# чека при массовой активации), отправляются из небольшого пула.
+NOTIFY_WORKERS = 4
+_notify_pool = ThreadPoolExecutor(max_workers=NOTIFY_WORKERS, thread_name_prefix='notify')
+
+def _send_quietly(chat_id, text, kwargs):
+    try:
+        bot.send_message(chat_id, text, **kwargs)
+    except Exception as e:
+        print(f"Notify {chat_id} error: {e}")
+
+def notify(chat_id, text, **kwargs):
+    _notify_pool.submit(_send_quietly, chat_id, text, kwargs)
 
 # Новый словарь для pending steps (чтобы не использовать встроенный next_step_handler и избежать запоминания)
 pending_steps = {}
@@ -303,12 +768,60 @@ def clear_pending_step(chat_id):
     if chat_id in pending_steps:
         del pending_steps[chat_id]
 
-def is_subscribed(user_id):
+# Кэш подписок на каналы: ключ (канал, пользователь). Положительный ответ живёт
+# дольше отрицательного, чтобы только что подписавшийся быстро прошёл проверку.
+# Ошибки Telegram не кэшируются. Несколько каналов проверяются параллельно.
+MEMBERSHIP_TTL = 300
+MEMBERSHIP_NEGATIVE_TTL = 15
+MEMBERSHIP_CACHE_SIZE = 50000
+MEMBERSHIP_WORKERS = 8
+
+_membership_cache = {}
+_membership_lock = threading.Lock()
+_membership_stats = {'hits': 0, 'misses': 0, 'errors': 0}
+_membership_pool = ThreadPoolExecutor(max_workers=MEMBERSHIP_WORKERS, thread_name_prefix='membership')
+
+def is_member(channel, user_id):
+    key = (channel, user_id)
+    now = time.monotonic()
+    with _membership_lock:
+        entry = _membership_cache.get(key)
+        if entry and entry[1] > now:
+            _membership_stats['hits'] += 1
+            return entry[0]
+        _membership_stats['misses'] += 1
     try:
-        member = bot.get_chat_member(config.CHANNEL, user_id)
-        return member.status in ['member', 'administrator', 'creator']
-    except:
+        member = bot.get_chat_member(channel, user_id)
+    except Exception:
+        with _membership_lock:
+            _membership_stats['errors'] += 1
         return False
+    subscribed = member.status in ['member', 'administrator', 'creator']
+    ttl = MEMBERSHIP_TTL if subscribed else MEMBERSHIP_NEGATIVE_TTL
+    with _membership_lock:
+        if len(_membership_cache) >= MEMBERSHIP_CACHE_SIZE:
+            for k in [k for k, v in _membership_cache.items() if v[1] <= now]:
+                del _membership_cache[k]
+            if len(_membership_cache) >= MEMBERSHIP_CACHE_SIZE:
+                _membership_cache.clear()
+        _membership_cache[key] = (subscribed, now + ttl)
+    return subscribed
+
+def is_member_of_all(channels, user_id):
+    channels = list(channels)
+    if len(channels) <= 1:
+        return all(is_member(channel, user_id) for channel in channels)
+    return all(_membership_pool.map(lambda channel: is_member(channel, user_id), channels))
+
+def membership_cache_stats():
+    with _membership_lock:
+        stats = dict(_membership_stats, size=len(_membership_cache))
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else 0.0
+    return stats
+
+def is_subscribed(user_id):
+    return is_member(config.CHANNEL, user_id)
 
 def generate_referral_code(user_id):
     return f"ref_{user_id}"
@@ -328,80 +841,673 @@ def get_profit_level(referrals, is_admin=False):
         return 'VIP WORK'
 
 def is_admin(user_id):
-    cursor.execute("SELECT * FROM admins WHERE id = ?", (user_id,))
-    return cursor.fetchone() is not None
+    return user_id in _admin_ids
 
-tz = pytz.timezone('Europe/Moscow')
+# Журнал действий пишется отдельным потоком: записи копятся в памяти и
+# сбрасываются одной транзакцией (executemany) по размеру пачки или по таймеру.
+AUDIT_FLUSH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 2.0  # секунды
+
+_audit_queue = Queue()
+_AUDIT_STOP = object()
 
 def log_action(user_id, action):
-    cursor.execute("INSERT INTO logs (user_id, action, timestamp) VALUES (?, ?, ?)", (user_id, action, datetime.now(tz)))
-    conn.commit()
+    _audit_queue.put(('logs', (user_id, action, datetime.now(tz))))
 
 def log_admin_action(admin_id, action):
-    cursor.execute("INSERT INTO admin_logs (admin_id, action, timestamp) VALUES (?, ?, ?)", (admin_id, action, datetime.now(tz)))
-    conn.commit()
+    _audit_queue.put(('admin_logs', (admin_id, action, datetime.now(tz))))
+
+def _flush_audit(batch):
+    logs = [row for table, row in batch if table == 'logs']
+    admin_logs = [row for table, row in batch if table == 'admin_logs']
+    with db_transaction() as c:
+        if logs:
+            c.executemany("INSERT INTO logs (user_id, action, timestamp) VALUES (?, ?, ?)", logs)
+        if admin_logs:
+            c.executemany("INSERT INTO admin_logs (admin_id, action, timestamp) VALUES (?, ?, ?)", admin_logs)
+
+def _audit_writer():
+    batch = []
+    deadline = None
+    while True:
+        timeout = max(0, deadline - time.monotonic()) if batch else None
+        try:
+            item = _audit_queue.get(timeout=timeout)
+        except Empty:
+            item = None
+        stop = item is _AUDIT_STOP
+        if item is not None and not stop:
+            if not batch:
+                deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+            batch.append(item)
+        if batch and (stop or len(batch) >= AUDIT_FLUSH_SIZE or time.monotonic() >= deadline):
+            try:
+                _flush_audit(batch)
+            except Exception as e:
+                print(f"Audit log flush error: {e}")
+            batch = []
+        if stop:
+            return
+
+_audit_thread = threading.Thread(target=_audit_writer, name='audit-log', daemon=True)
+
+def start_audit_writer():
+    _audit_thread.start()
+
+def stop_audit_writer():
+    # Всё, что попало в очередь до стоп-метки, будет записано
+    _audit_queue.put(_AUDIT_STOP)
+    _audit_thread.join(timeout=30)
+
+# LRU-кэш пользователей. Любая запись в users сбрасывает запись кэша после
+# фиксации транзакции. Счётчик поколений не даёт положить в кэш строку,
+# прочитанную до чужой записи.
+USER_CACHE_SIZE = 10000
+
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+_user_cache_gen = 0
+_user_cache_hits = 0
+_user_cache_misses = 0
+
+USER_SQL = hot_query('get_user', "SELECT * FROM users WHERE id = ?", (0,))
 
 def get_user(user_id):
-    cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    row = cursor.fetchone()
-    if row:
-        columns = [desc[0] for desc in cursor.description]
-        return dict(zip(columns, row))
-    return None
+    global _user_cache_hits, _user_cache_misses
+    with _user_cache_lock:
+        user = _user_cache.get(user_id)
+        if user is not None:
+            _user_cache.move_to_end(user_id)
+            _user_cache_hits += 1
+            return dict(user)
+        _user_cache_misses += 1
+        gen = _user_cache_gen
+    user = db_fetchone_dict(USER_SQL, (user_id,))
+    if user is None:
+        return None
+    with _user_cache_lock:
+        if gen == _user_cache_gen:
+            _user_cache[user_id] = user
+            if len(_user_cache) > USER_CACHE_SIZE:
+                _user_cache.popitem(last=False)
+    return dict(user)
+
+def _drop_cached_users(user_ids):
+    global _user_cache_gen
+    with _user_cache_lock:
+        _user_cache_gen += 1
+        for user_id in user_ids:
+            _user_cache.pop(user_id, None)
+
+def invalidate_user(*user_ids):
+    db_after_commit(lambda: _drop_cached_users(user_ids))
+
+def user_cache_stats():
+    with _user_cache_lock:
+        total = _user_cache_hits + _user_cache_misses
+        return {'hits': _user_cache_hits, 'misses': _user_cache_misses, 'size': len(_user_cache),
+                'hit_rate': _user_cache_hits / total if total else 0.0}
 
 def update_user(user_id, **kwargs):
     set_clause = ', '.join(f"{k} = ?" for k in kwargs)
     values = list(kwargs.values()) + [user_id]
-    cursor.execute(f"UPDATE users SET {set_clause} WHERE id = ?", values)
-    conn.commit()
+    with db_transaction() as c:
+        c.execute(f"UPDATE users SET {set_clause} WHERE id = ?", values)
+        invalidate_user(user_id)
+        if 'reputation' in kwargs or 'subscription_type' in kwargs:
+            db_after_commit(lambda: _reprioritize_user(user_id))
+
+# Денежные операции. Баланс меняется инкрементом прямо в SQL, а проверка
+# «хватает ли средств» — условие того же UPDATE, поэтому параллельные
+# операции не теряют обновления. Вызывать внутри db_transaction(), чтобы
+# движение денег и сопутствующие записи фиксировались одной транзакцией.
+#
+# Источник истины — журнал проводок postings (только добавление, двойная
+# запись: сумма проводок каждой операции равна нулю). Колонки card_balance и
+# balance в users — материализованные остатки, которые обновляются вместе с
+# проводками, поэтому чтение баланса остаётся чтением одной строки.
+LEDGER_COLUMNS = ('card_balance', 'balance')
+
+# Системные счета (user_id = 0) — вторая сторона проводки
+LEDGER_SYSTEM_USER = 0
+LEDGER_EXTERNAL = 'external'        # ввод/вывод денег вне бота
+LEDGER_CHECKS = 'checks'            # деньги в неактивированных чеках
+LEDGER_WITHDRAWALS = 'withdrawals'  # заявки на вывод в ожидании выплаты
+LEDGER_REFERRALS = 'referrals'      # реферальные начисления
+LEDGER_PAYROLL = 'payroll'          # выплаты за холды
+
+class InsufficientFunds(Exception):
+    pass
 
-def get_queue():
-    cursor.execute("SELECT * FROM queue ORDER BY added_time ASC")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+def _ledger_entry(c, txn_id, user_id, account, amount, kind, now):
+    c.execute("INSERT INTO postings (txn_id, user_id, account, amount, kind, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+              (txn_id, user_id, account, amount, kind, now))
+
+def ledger_post(c, user_id, delta, kind, column='card_balance', contra=LEDGER_EXTERNAL, now=None, txn_id=None, transfer_id=None, counterparty_id=None):
+    if column not in LEDGER_COLUMNS:
+        raise ValueError(f"Unknown ledger column: {column}")
+    now = now or datetime.now(tz)
+    cur = c.execute(f"UPDATE users SET {column} = {column} + ? WHERE id = ? AND {column} + ? >= 0", (delta, user_id, delta))
+    if cur.rowcount == 0:
+        if delta < 0:
+            raise InsufficientFunds(user_id)
+        raise LookupError(f"User {user_id} not found")
+    invalidate_user(user_id)
+    txn_id = txn_id or uuid.uuid4().hex
+    _ledger_entry(c, txn_id, user_id, column, delta, kind, now)
+    if contra:
+        _ledger_entry(c, txn_id, LEDGER_SYSTEM_USER, contra, -delta, kind, now)
+    if column == 'card_balance':
+        c.execute("INSERT INTO card_history (user_id, amount, timestamp, type, transfer_id, counterparty_id) VALUES (?, ?, ?, ?, ?, ?)",
+                  (user_id, delta, now, kind, transfer_id, counterparty_id))
+
+def ledger_post_many(c, amounts, kind, column='balance', contra=LEDGER_EXTERNAL, now=None, txn_id=None):
+    # Пакетное начисление {user_id: сумма}: executemany по users и postings,
+    # одна общая проводка на системный счёт
+    if column not in LEDGER_COLUMNS:
+        raise ValueError(f"Unknown ledger column: {column}")
+    items = [(user_id, amount) for user_id, amount in amounts.items() if amount]
+    if any(amount < 0 for _, amount in items):
+        raise ValueError("ledger_post_many only credits")
+    if not items:
+        return
+    now = now or datetime.now(tz)
+    txn_id = txn_id or uuid.uuid4().hex
+    cur = c.executemany(f"UPDATE users SET {column} = {column} + ? WHERE id = ?", [(amount, user_id) for user_id, amount in items])
+    if cur.rowcount != len(items):
+        raise LookupError("Some users not found")
+    invalidate_user(*(user_id for user_id, _ in items))
+    c.executemany("INSERT INTO postings (txn_id, user_id, account, amount, kind, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                  [(txn_id, user_id, column, amount, kind, now) for user_id, amount in items])
+    if contra:
+        _ledger_entry(c, txn_id, LEDGER_SYSTEM_USER, contra, -sum(amount for _, amount in items), kind, now)
+    if column == 'card_balance':
+        c.executemany("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", [(user_id, amount, now, kind) for user_id, amount in items])
+
+def ledger_transfer(c, from_user_id, to_user_id, amount):
+    now = datetime.now(tz)
+    txn_id = uuid.uuid4().hex
+    transfer_id = c.execute("INSERT INTO transfers (from_user_id, to_user_id, amount, timestamp) VALUES (?, ?, ?, ?)", (from_user_id, to_user_id, amount, now)).lastrowid
+    ledger_post(c, from_user_id, -amount, 'transfer_out', contra=None, now=now, txn_id=txn_id, transfer_id=transfer_id, counterparty_id=to_user_id)
+    ledger_post(c, to_user_id, amount, 'transfer_in', contra=None, now=now, txn_id=txn_id, transfer_id=transfer_id, counterparty_id=from_user_id)
+
+# Снимки остатков: для каждого счёта хранится остаток на момент проводки
+# posting_id, а общий водяной знак — в status. Пересчёт счёта читает снимок и
+# только проводки после него, а не весь журнал с начала.
+LEDGER_SNAPSHOT_INTERVAL = 6 * 60 * 60  # секунды
+
+def _snapshot_watermark(c):
+    row = c.execute("SELECT value FROM status WHERE key = 'ledger_snapshot_posting_id'").fetchone()
+    return int(row[0]) if row else 0
+
+def take_balance_snapshots():
+    with db_transaction() as c:
+        watermark = _snapshot_watermark(c)
+        last_id = c.execute("SELECT COALESCE(MAX(id), 0) FROM postings").fetchone()[0]
+        if last_id <= watermark:
+            return 0
+        cur = c.execute('''
+        INSERT INTO balance_snapshots (user_id, account, posting_id, balance, created_at)
+        SELECT user_id, account, MAX(id), SUM(amount), ? FROM postings
+        WHERE id > ? AND id <= ?
+        GROUP BY user_id, account
+        ON CONFLICT (user_id, account) DO UPDATE SET
+            balance = balance + excluded.balance,
+            posting_id = excluded.posting_id,
+            created_at = excluded.created_at
+        ''', (datetime.now(tz), watermark, last_id))
+        c.execute("REPLACE INTO status (key, value) VALUES ('ledger_snapshot_posting_id', ?)", (str(last_id),))
+        return cur.rowcount
+
+BALANCE_SNAPSHOT_SQL = hot_query('balance_snapshot', "SELECT posting_id, balance FROM balance_snapshots WHERE user_id = ? AND account = ?", (0, ''))
+BALANCE_TAIL_SQL = hot_query('rebuild_balance', "SELECT COALESCE(SUM(amount), 0) FROM postings WHERE user_id = ? AND account = ? AND id > ?", (0, '', 0))
+
+def rebuild_balance(user_id, column='card_balance'):
+    snapshot = db_fetchone(BALANCE_SNAPSHOT_SQL, (user_id, column))
+    posting_id, balance = snapshot or (0, 0.0)
+    tail = db_fetchone(BALANCE_TAIL_SQL, (user_id, column, posting_id))[0]
+    return balance + tail
+
+def reconcile_balances(tolerance=1e-6):
+    # Сверка материализованных остатков с журналом: снимки + хвост после водяного знака
+    watermark = _snapshot_watermark(get_conn())
+    rebuilt = {}
+    for user_id, account, balance in db_fetchall("SELECT user_id, account, balance FROM balance_snapshots"):
+        rebuilt[(user_id, account)] = balance
+    for user_id, account, delta in db_fetchall("SELECT user_id, account, SUM(amount) FROM postings WHERE id > ? GROUP BY user_id, account", (watermark,)):
+        rebuilt[(user_id, account)] = rebuilt.get((user_id, account), 0.0) + delta
+    mismatches = []
+    for user_id, card_balance, balance in db_fetchall("SELECT id, card_balance, balance FROM users"):
+        for column, value in (('card_balance', card_balance), ('balance', balance)):
+            expected = rebuilt.get((user_id, column), 0.0)
+            if abs((value or 0.0) - expected) > tolerance:
+                mismatches.append((user_id, column, value, expected))
+    total = sum(rebuilt.values())
+    if abs(total) > tolerance:
+        mismatches.append((None, 'ledger_total', total, 0.0))
+    return mismatches
+
+# Сверка по расписанию: расхождения пишутся в лог и уходят админам
+LEDGER_RECONCILE_INTERVAL = 60 * 60  # секунды
+LEDGER_RECONCILE_REPORT = 20
+
+def format_mismatches(mismatches):
+    lines = [f"{user_id if user_id is not None else '—'} {account}: {value} вместо {round(expected, 2)}"
+             for user_id, account, value, expected in mismatches[:LEDGER_RECONCILE_REPORT]]
+    if len(mismatches) > LEDGER_RECONCILE_REPORT:
+        lines.append(f"… и ещё {len(mismatches) - LEDGER_RECONCILE_REPORT}")
+    return "\n".join(lines)
+
+def check_ledger():
+    mismatches = reconcile_balances()
+    if mismatches:
+        print(f"Ledger mismatch: {mismatches}")
+        for admin_id in _admin_ids:
+            notify(admin_id, f"⚠️ Остатки расходятся с журналом ({len(mismatches)}):\n{format_mismatches(mismatches)}")
+    return mismatches
+
+# Помесячные выписки по карте строятся по журналу проводок счёта card_balance.
+# Закрытый месяц уже не меняется: его итоги считаются один раз (фоном или при
+# первом просмотре) и дальше читаются из card_statements. Остаток на начало —
+# закрытие прошлой выписки, а если её нет — сумма журнала до начала месяца.
+# Текущий месяц считается на лету. Месяцы до начала журнала не показываются.
+STATEMENT_MONTHS = 6
+STATEMENT_INTERVAL = 6 * 60 * 60  # секунды
+
+def _month_bounds(month):
+    start = datetime.strptime(month, '%Y-%m')
+    end = (start + timedelta(days=32)).replace(day=1)
+    return tz.localize(start), tz.localize(end)
+
+def _previous_month(month):
+    return (datetime.strptime(month, '%Y-%m') - timedelta(days=1)).strftime('%Y-%m')
+
+@lru_cache(maxsize=1)
+def ledger_started_at():
+    row = db_fetchone("SELECT value FROM status WHERE key = 'ledger_started_at'")
+    return datetime.fromisoformat(row[0])
+
+def statement_available(month):
+    return _month_bounds(month)[1] > ledger_started_at()
+
+CARD_STATEMENT_SQL = hot_query('card_statement_cached', "SELECT * FROM card_statements WHERE user_id = ? AND month = ?", (0, ''))
+CARD_CLOSING_SQL = hot_query('card_statement_previous', "SELECT closing FROM card_statements WHERE user_id = ? AND month = ?", (0, ''))
+CARD_OPENING_SQL = hot_query('card_statement_opening', "SELECT COALESCE(SUM(amount), 0.0) FROM postings WHERE user_id = ? AND account = 'card_balance' AND created_at < ?", (0, ''))
+CARD_MONTH_SQL = hot_query('card_statement_month', """
+    SELECT kind, COUNT(*), SUM(amount), SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END)
+    FROM postings WHERE user_id = ? AND account = 'card_balance' AND created_at >= ? AND created_at < ? GROUP BY kind""", (0, '', ''))
+
+def _compute_card_statement(c, user_id, month):
+    start, end = _month_bounds(month)
+    previous = c.execute(CARD_CLOSING_SQL, (user_id, _previous_month(month))).fetchone()
+    if previous:
+        opening = previous[0]
+    else:
+        opening = c.execute(CARD_OPENING_SQL, (user_id, start)).fetchone()[0]
+    by_type, credits, debits, operations = {}, 0.0, 0.0, 0
+    for kind, count, total, positive in c.execute(CARD_MONTH_SQL, (user_id, start, end)):
+        if kind == 'opening':
+            # Остаток, перенесённый в журнал при его запуске, — это остаток на начало, а не поступление
+            opening += total
+            continue
+        by_type[kind] = [count, round(total, 2)]
+        credits += positive
+        debits += total - positive
+        operations += count
+    return {'user_id': user_id, 'month': month, 'opening': round(opening, 2), 'credits': round(credits, 2), 'debits': round(debits, 2),
+            'closing': round(opening + credits + debits, 2), 'operations': operations, 'by_type': by_type}
+
+def _store_card_statement(c, statement):
+    c.execute("""
+        INSERT OR IGNORE INTO card_statements (user_id, month, opening, credits, debits, closing, operations, by_type, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", (statement['user_id'], statement['month'], statement['opening'], statement['credits'], statement['debits'],
+                                               statement['closing'], statement['operations'], json.dumps(statement['by_type']), datetime.now(tz)))
+
+def card_statement(user_id, month):
+    if not statement_available(month):
+        return None
+    if month >= datetime.now(tz).strftime('%Y-%m'):
+        return _compute_card_statement(get_conn(), user_id, month)
+    row = db_fetchone_dict(CARD_STATEMENT_SQL, (user_id, month))
+    if row:
+        row['by_type'] = json.loads(row['by_type'])
+        return row
+    with db_transaction() as c:
+        statement = _compute_card_statement(c, user_id, month)
+        _store_card_statement(c, statement)
+    return statement
+
+def precompute_card_statements():
+    # Выписки за прошлый месяц для всех держателей карт, пачками по id
+    month = _previous_month(datetime.now(tz).strftime('%Y-%m'))
+    if not statement_available(month):
+        return 0
+    total, last_id = 0, 0
+    while True:
+        with db_transaction() as c:
+            ids = [row[0] for row in c.execute("""
+                SELECT id FROM users
+                WHERE id > ? AND card_number IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM card_statements s WHERE s.user_id = users.id AND s.month = ?)
+                ORDER BY id LIMIT ?""", (last_id, month, SWEEP_BATCH))]
+            for user_id in ids:
+                _store_card_statement(c, _compute_card_statement(c, user_id, month))
+        if not ids:
+            return total
+        total += len(ids)
+        last_id = ids[-1]
+
+# Все отложенные действия (окно активации, холды, периодические задачи) идут
+# через один поток-планировщик с кучей сроков вместо Timer-потока на каждое
+# событие. Отмена — O(1): запись убирается из словаря, а устаревший элемент
+# кучи пропускается при извлечении. Сроки с persist=True лежат в таблице timers
+# и поднимаются после рестарта; просроченные срабатывают сразу.
+TIMER_HANDLERS = {}
+TIMER_WORKERS = 4
+
+def timer_handler(kind):
+    def register(func):
+        TIMER_HANDLERS[kind] = func
+        return func
+    return register
+
+class Scheduler:
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=TIMER_WORKERS, thread_name_prefix='timer')
+
+    def _arm(self, key, kind, payload, due_at, persist):
+        with self._cond:
+            seq = next(self._seq)
+            self._entries[key] = (seq, kind, payload, persist)
+            heapq.heappush(self._heap, (due_at, seq, key))
+            self._cond.notify()
+
+    def _disarm(self, key):
+        with self._cond:
+            self._entries.pop(key, None)
+
+    def schedule(self, key, kind, delay, payload=None, persist=True):
+        # Внутри транзакции срок сохраняется вместе с ней и взводится после фиксации
+        due_at = time.time() + delay
+        if persist:
+            db_execute("INSERT OR REPLACE INTO timers (key, kind, payload, due_at) VALUES (?, ?, ?, ?)", (key, kind, json.dumps(payload), due_at))
+        db_after_commit(lambda: self._arm(key, kind, payload, due_at, persist))
+
+    def cancel(self, key):
+        db_execute("DELETE FROM timers WHERE key = ?", (key,))
+        db_after_commit(lambda: self._disarm(key))
+
+    def pending(self, key):
+        with self._cond:
+            return key in self._entries
+
+    def load(self):
+        for key, kind, payload, due_at in db_fetchall("SELECT key, kind, payload, due_at FROM timers"):
+            self._arm(key, kind, json.loads(payload), due_at, True)
+
+    def start(self):
+        threading.Thread(target=self._run, name='scheduler', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # Отменённые и перевзведённые записи снимаются с верха кучи
+                    while self._heap and self._entries.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+                        heapq.heappop(self._heap)
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                _, _, key = heapq.heappop(self._heap)
+                _, kind, payload, persist = self._entries.pop(key)
+            self._pool.submit(self._fire, key, kind, payload, persist)
+
+    def _fire(self, key, kind, payload, persist):
+        try:
+            TIMER_HANDLERS[kind](payload)
+        except Exception as e:
+            print(f"Timer {key} ({kind}) error: {e}")
+        if persist and not self.pending(key):
+            db_execute("DELETE FROM timers WHERE key = ? AND due_at <= ?", (key, time.time()))
 
-def get_user_queue(user_id):
-    cursor.execute("SELECT * FROM queue WHERE user_id = ? ORDER BY added_time ASC", (user_id,))
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+scheduler = Scheduler()
 
-def get_working(user_id=None):
-    if user_id:
-        cursor.execute("SELECT * FROM working WHERE user_id = ?", (user_id,))
-    else:
-        cursor.execute("SELECT * FROM working")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+_periodic_jobs = {}
 
-def get_successful(user_id=None):
-    if user_id:
-        cursor.execute("SELECT * FROM successful WHERE user_id = ?", (user_id,))
-    else:
-        cursor.execute("SELECT * FROM successful")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+@timer_handler('periodic')
+def _run_periodic_job(payload):
+    interval, name = payload
+    try:
+        _periodic_jobs[name]()
+    finally:
+        scheduler.schedule(f"periodic:{name}", 'periodic', interval, payload, persist=False)
+
+def run_periodic(interval, func, name):
+    _periodic_jobs[name] = func
+    scheduler.schedule(f"periodic:{name}", 'periodic', interval, (interval, name), persist=False)
+
+DEPOSIT_BY_PAYLOAD_SQL = hot_query('payment_by_payload', f"SELECT id, user_id, amount FROM payments WHERE payload = ? AND sub_type = 'deposit' AND status IN {PAYABLE_STATUSES}", ('',))
+
+def credit_deposit(payment_id, user_id, amount, transaction_id=None):
+    # Платёж помечается оплаченным условно — повторное подтверждение ничего не зачислит.
+    # Просроченный счёт тоже зачисляется: сам инвойс у платёжки остаётся оплачиваемым.
+    with db_transaction() as c:
+        paid = c.execute(f"UPDATE payments SET status = 'paid', transaction_id = COALESCE(?, transaction_id) WHERE id = ? AND status IN {PAYABLE_STATUSES}", (transaction_id, payment_id)).rowcount
+        if not paid:
+            return False
+        ledger_post(c, user_id, amount, 'deposit')
+        c.execute("INSERT INTO deposit_history (user_id, amount, created_at, request_id) VALUES (?, ?, ?, ?)", (user_id, amount, datetime.now(tz), payment_id))
+    return True
+
+# Дневные сводки по (день, пользователь, тип): сколько номеров добавлено, взято,
+# успешно, в блоке, снято, удалено владельцем, плюс суммы минут ожидания и холда. Для медиан —
+# гистограммы по минутам. Обновляются в той же транзакции, что и смена
+# состояния номера, так что статистика не сканирует историю.
+ROLLUP_FIELDS = ('added', 'taken', 'successful', 'blocked', 'dropped', 'removed')
+
+def rollup_day(when):
+    return when.astimezone(tz).strftime('%Y-%m-%d')
+
+def record_rollup(c, user_id, number_type, field, count=1, when=None, wait=None, hold=None):
+    if field not in ROLLUP_FIELDS:
+        raise ValueError(f"Unknown rollup field: {field}")
+    day = rollup_day(when or datetime.now(tz))
+    number_type = number_type or ''
+    c.execute(f"""
+        INSERT INTO daily_stats (day, user_id, type, {field}, wait_minutes, hold_minutes) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (day, user_id, type) DO UPDATE SET
+            {field} = {field} + excluded.{field},
+            wait_minutes = wait_minutes + excluded.wait_minutes,
+            hold_minutes = hold_minutes + excluded.hold_minutes
+        """, (day, user_id, number_type, count, wait or 0, hold or 0))
+    for metric, minutes in (('wait', wait), ('hold', hold)):
+        if minutes is not None:
+            c.execute("""
+                INSERT INTO daily_histograms (day, user_id, type, metric, bucket, count) VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT (day, metric, user_id, type, bucket) DO UPDATE SET count = count + 1
+                """, (day, user_id, number_type, metric, min(int(minutes), ROLLUP_MAX_BUCKET)))
+
+def histogram_percentile(buckets, q):
+    # buckets: [(минуты, количество)] по возрастанию
+    total = sum(count for _, count in buckets)
+    if not total:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for bucket, count in buckets:
+        seen += count
+        if seen > rank:
+            return bucket
+    return buckets[-1][0]
+
+def _rollup_filters(number_type=None, user_id=None, alias=''):
+    sql, params = "", []
+    if number_type:
+        sql += f" AND {alias}type = ?"
+        params.append(number_type)
+    if user_id is not None:
+        sql += f" AND {alias}user_id = ?"
+        params.append(user_id)
+    return sql, params
+
+def _rollup_summary_sql(filters):
+    return f"""
+        SELECT COALESCE(SUM(added), 0) AS added, COALESCE(SUM(taken), 0) AS taken,
+               COALESCE(SUM(successful), 0) AS successful, COALESCE(SUM(blocked), 0) AS blocked,
+               COALESCE(SUM(dropped), 0) AS dropped, COALESCE(SUM(removed), 0) AS removed, COALESCE(SUM(hold_minutes), 0) AS hold_minutes
+        FROM daily_stats WHERE day >= ? AND day <= ?{filters}"""
+
+def _rollup_histogram_sql(filters):
+    return f"SELECT bucket, SUM(count) FROM daily_histograms WHERE day >= ? AND day <= ? AND metric = ?{filters} GROUP BY bucket ORDER BY bucket"
+
+def _worker_stats_sql(joined_filters):
+    return f"""
+        SELECT d.user_id, u.username, SUM(d.added) AS added, SUM(d.taken) AS taken, SUM(d.successful) AS successful,
+               SUM(d.blocked) AS blocked, SUM(d.dropped) AS dropped, SUM(d.hold_minutes) AS hold_minutes
+        FROM daily_stats d LEFT JOIN users u ON u.id = d.user_id
+        WHERE d.day >= ? AND d.day <= ?{joined_filters}
+        GROUP BY d.user_id
+        ORDER BY successful DESC, hold_minutes DESC, d.user_id"""
+
+def _worker_histograms_sql(filters):
+    return f"SELECT user_id, bucket, SUM(count) FROM daily_histograms WHERE day >= ? AND day <= ? AND metric = 'hold'{filters} GROUP BY user_id, bucket ORDER BY user_id, bucket"
+
+def _worker_days_sql(filters):
+    return f"""
+        SELECT day, SUM(added) AS added, SUM(successful) AS successful, SUM(blocked) AS blocked, SUM(hold_minutes) AS hold_minutes
+        FROM daily_stats WHERE user_id = ? AND day >= ? AND day <= ?{filters}
+        GROUP BY day ORDER BY day DESC LIMIT ?"""
+
+def _register_rollup_queries():
+    # Все сочетания фильтров, с которыми экраны статистики строят запросы
+    for number_type in (None, 'vc'):
+        for user_id in (None, 0):
+            filters, params = _rollup_filters(number_type, user_id)
+            suffix = f"{':type' if number_type else ''}{':user' if user_id is not None else ''}"
+            hot_query('rollup_summary' + suffix, _rollup_summary_sql(filters), ['', ''] + params)
+            hot_query('rollup_histogram' + suffix, _rollup_histogram_sql(filters), ['', '', ''] + params)
+        filters, params = _rollup_filters(number_type)
+        joined_filters, _ = _rollup_filters(number_type, alias='d.')
+        suffix = ':type' if number_type else ''
+        hot_query('worker_stats' + suffix, _worker_stats_sql(joined_filters), ['', ''] + params)
+        hot_query('worker_histograms' + suffix, _worker_histograms_sql(filters), ['', ''] + params)
+        hot_query('worker_days' + suffix, _worker_days_sql(filters), [0, '', ''] + params + [0])
+
+_register_rollup_queries()
+
+def rollup_summary(start_day, end_day, number_type=None, user_id=None):
+    # Итоги за дни [start_day, end_day] плюс медиана и p90 ожидания и холда
+    filters, params = _rollup_filters(number_type, user_id)
+    row = db_fetchone_dict(_rollup_summary_sql(filters), [start_day, end_day] + params)
+    for metric in ('wait', 'hold'):
+        buckets = db_fetchall(_rollup_histogram_sql(filters), [start_day, end_day, metric] + params)
+        row[f'median_{metric}'] = histogram_percentile(buckets, 0.5)
+        row[f'p90_{metric}'] = histogram_percentile(buckets, 0.9)
+    return row
+
+def worker_stats(start_day, end_day, number_type=None):
+    # Итоги по воркерам одним сгруппированным запросом (имя — из JOIN, без
+    # get_user на строку) и перцентили холда по их гистограммам вторым
+    filters, params = _rollup_filters(number_type)
+    joined_filters, _ = _rollup_filters(number_type, alias='d.')
+    workers = db_fetchall_dicts(_worker_stats_sql(joined_filters), [start_day, end_day] + params)
+    rows = db_fetchall(_worker_histograms_sql(filters), [start_day, end_day] + params)
+    percentiles = {}
+    for user_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        buckets = [(bucket, count) for _, bucket, count in group]
+        percentiles[user_id] = (histogram_percentile(buckets, 0.5), histogram_percentile(buckets, 0.9))
+    for worker in workers:
+        worker['median_hold'], worker['p90_hold'] = percentiles.get(worker['user_id'], (None, None))
+    return workers
+
+def worker_days(user_id, start_day, end_day, number_type=None, limit=10):
+    filters, params = _rollup_filters(number_type)
+    return db_fetchall_dicts(_worker_days_sql(filters), [user_id, start_day, end_day] + params + [limit])
+
+# Экран статистики открывают сразу несколько админов: результат держится
+# STATS_TTL секунд, а считает его один поток — остальные ждут на замке и
+# получают готовое.
+STATS_TTL = 30  # секунды
+_stats_cache = {}
+_stats_lock = threading.Lock()
+
+def cached_stats(key, compute):
+    with _stats_lock:
+        now = time.monotonic()
+        entry = _stats_cache.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+        result = compute()
+        for k in [k for k, v in _stats_cache.items() if v[0] <= now]:
+            del _stats_cache[k]
+        _stats_cache[key] = (time.monotonic() + STATS_TTL, result)
+        return result
+
+# Счётчики очереди (общий и по пользователям) держатся в памяти: главное меню
+# не читает очередь целиком. Изменения применяются после фиксации транзакции,
+# при старте счётчики собираются из БД.
+_queue_total = 0
+_queue_by_user = {}
+_queue_counts_lock = threading.Lock()
+
+def rebuild_queue_counters():
+    global _queue_total, _queue_by_user
+    by_user = dict(db_fetchall("SELECT user_id, COUNT(*) FROM numbers WHERE state = 'queued' GROUP BY user_id"))
+    with _queue_counts_lock:
+        _queue_by_user = by_user
+        _queue_total = sum(by_user.values())
+
+def _apply_queue_delta(user_id, delta):
+    global _queue_total
+    with _queue_counts_lock:
+        _queue_total = max(0, _queue_total + delta)
+        count = _queue_by_user.get(user_id, 0) + delta
+        if count > 0:
+            _queue_by_user[user_id] = count
+        else:
+            _queue_by_user.pop(user_id, None)
 
-def get_blocked(user_id=None):
-    if user_id:
-        cursor.execute("SELECT * FROM blocked WHERE user_id = ?", (user_id,))
-    else:
-        cursor.execute("SELECT * FROM blocked")
-    rows = cursor.fetchall()
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in rows]
+def note_queue_change(user_id, delta):
+    if delta:
+        db_after_commit(lambda: _apply_queue_delta(user_id, delta))
+
+def queue_size():
+    return _queue_total
+
+def user_queue_size(user_id):
+    return _queue_by_user.get(user_id, 0)
+
+def get_queue_items(item_ids):
+    # Строки очереди в порядке переданных id
+    if not item_ids:
+        return []
+    placeholders = ', '.join('?' * len(item_ids))
+    rows = {row['id']: row for row in db_fetchall_dicts(f"SELECT * FROM numbers WHERE id IN ({placeholders}) AND state = 'queued'", item_ids)}
+    return [rows[item_id] for item_id in item_ids if item_id in rows]
+
+# view — ключ NUMBER_VIEWS; по индексу (user_id, state) строки уже идут по id
+USER_NUMBERS_SQL = {view: hot_query(f'get_user_numbers:{view}', f"SELECT * FROM numbers WHERE user_id = ? AND state IN ({', '.join('?' * len(states))}) ORDER BY id", (0,) + states)
+                    for view, states in NUMBER_VIEWS.items()}
+USER_NUMBER_COUNTS_SQL = hot_query('user_number_counts', "SELECT state, COUNT(*) FROM numbers WHERE user_id = ? GROUP BY state", (0,))
+
+def get_user_numbers(user_id, view):
+    return db_fetchall_dicts(USER_NUMBERS_SQL[view], (user_id,) + NUMBER_VIEWS[view])
+
+def user_number_counts(user_id):
+    by_state = dict(db_fetchall(USER_NUMBER_COUNTS_SQL, (user_id,)))
+    return {view: sum(by_state.get(state, 0) for state in states) for view, states in NUMBER_VIEWS.items()}
 
 def get_status(key):
-    cursor.execute("SELECT value FROM status WHERE key = ?", (key,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT value FROM status WHERE key = ?", (key,))
     return row[0] if row else None
 
 def set_status(key, value):
-    cursor.execute("REPLACE INTO status (key, value) VALUES (?, ?)", (key, value))
-    conn.commit()
+    db_execute("REPLACE INTO status (key, value) VALUES (?, ?)", (key, value))
 
 def generate_card_number():
     return ''.join(random.choices(string.digits, k=16))
@@ -431,22 +1537,309 @@ def get_price_increase(sub_type):
     sub = config.SUBSCRIPTIONS.get(sub_type, {})
     return sub.get('price_increase_hour', 0), sub.get('price_increase_30min', 0)
 
-def sort_queue(queue):
-    def key_func(item):
-        user = get_user(item['user_id'])
-        rep = user['reputation']
-        sub = user['subscription_type']
-        priority = 0
-        if sub == 'VIP Nexus':
-            priority = 4
-        elif sub == 'Prime Plus':
-            priority = 3
-        elif sub == 'Gold Tier':
-            priority = 2
-        elif sub == 'Elite Access':
-            priority = 1
-        return (-priority, -rep, item['added_time'])
-    return sorted(queue, key=key_func)
+# Приоритет очереди: подписка, затем репутация, затем время добавления.
+SUBSCRIPTION_PRIORITY = {'VIP Nexus': 4, 'Prime Plus': 3, 'Gold Tier': 2, 'Elite Access': 1}
+
+class _SortedBuckets:
+    # Отсортированный список из корзин по ~LOAD ключей. Дерево Фенвика по
+    # размерам корзин даёт позицию ключа за O(log n), вставка и удаление —
+    # бинарный поиск плюс сдвиг внутри одной корзины.
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._buckets = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [b[-1] for b in self._buckets]
+        self._size = len(keys)
+        self._rebuild_tree()
+
+    def _rebuild_tree(self):
+        tree = [0] * (len(self._buckets) + 1)
+        for i, bucket in enumerate(self._buckets, 1):
+            tree[i] += len(bucket)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, i, delta):
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _tree_prefix(self, i):
+        total = 0
+        while i:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._buckets)
+
+    def add(self, key):
+        self._size += 1
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        i = min(bisect_left(self._maxes, key), len(self._buckets) - 1)
+        bucket = self._buckets[i]
+        insort(bucket, key)
+        self._maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.LOAD:
+            self._buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self._maxes[i:i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+            self._rebuild_tree()
+        else:
+            self._tree_add(i, 1)
+
+    def remove(self, key):
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        self._size -= 1
+        if bucket:
+            self._maxes[i] = bucket[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+            self._rebuild_tree()
+
+    def first(self):
+        return self._buckets[0][0] if self._buckets else None
+
+    def irange(self, key=None, reverse=False):
+        # Ключи строго после key по возрастанию, при reverse — строго до key по убыванию
+        if not self._buckets:
+            return iter(())
+        if reverse:
+            i = len(self._buckets) - 1 if key is None else min(bisect_left(self._maxes, key), len(self._buckets) - 1)
+            bucket = self._buckets[i]
+            j = len(bucket) if key is None else bisect_left(bucket, key)
+            return itertools.chain(reversed(bucket[:j]), (k for b in reversed(self._buckets[:i]) for k in reversed(b)))
+        if key is None:
+            return iter(self)
+        i = bisect_left(self._maxes, key)
+        if i == len(self._buckets):
+            return iter(())
+        return itertools.chain(self._buckets[i][bisect_right(self._buckets[i], key):], itertools.chain.from_iterable(self._buckets[i + 1:]))
+
+    def rank(self, key):
+        # Сколько ключей строго меньше key
+        i = bisect_left(self._maxes, key)
+        if i == len(self._buckets):
+            return self._size
+        return self._tree_prefix(i) + bisect_left(self._buckets[i], key)
+
+QUEUE_REBUILD_SQL = hot_query('queue_rebuild', """
+    SELECT n.id, n.user_id, n.type, n.added_time, u.subscription_type, u.reputation
+    FROM numbers n LEFT JOIN users u ON u.id = n.user_id WHERE n.state = 'queued'""", ())
+
+class QueueIndex:
+    # Индекс очереди в памяти: по отдельному отсортированному списку на тип
+    # номера. Ключ — (-приоритет подписки, -репутация, время добавления, id).
+    # Собирается из БД при старте и дальше обновляется после фиксации транзакций.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_type = {}
+        self._items = {}
+        self._user_items = {}
+
+    @staticmethod
+    def _key(item_id, added_time, subscription_type, reputation):
+        ts = added_time.timestamp() if isinstance(added_time, datetime) else 0.0
+        return (-SUBSCRIPTION_PRIORITY.get(subscription_type, 0), -(reputation or 0), ts, item_id)
+
+    def rebuild(self):
+        rows = db_fetchall(QUEUE_REBUILD_SQL)
+        by_type, items, user_items = {}, {}, {}
+        for item_id, user_id, number_type, added_time, sub, rep in rows:
+            key = self._key(item_id, added_time, sub, rep)
+            by_type.setdefault(number_type, []).append(key)
+            items[item_id] = (number_type, key, user_id)
+            user_items.setdefault(user_id, set()).add(item_id)
+        with self._lock:
+            self._by_type = {t: _SortedBuckets(keys) for t, keys in by_type.items()}
+            self._items = items
+            self._user_items = user_items
+
+    def add(self, item_id, user_id, number_type, added_time, subscription_type, reputation):
+        key = self._key(item_id, added_time, subscription_type, reputation)
+        with self._lock:
+            if item_id in self._items:
+                return
+            self._by_type.setdefault(number_type, _SortedBuckets()).add(key)
+            self._items[item_id] = (number_type, key, user_id)
+            self._user_items.setdefault(user_id, set()).add(item_id)
+
+    def remove(self, item_id):
+        with self._lock:
+            entry = self._items.pop(item_id, None)
+            if entry is None:
+                return
+            number_type, key, user_id = entry
+            self._by_type[number_type].remove(key)
+            user_items = self._user_items.get(user_id)
+            if user_items is not None:
+                user_items.discard(item_id)
+                if not user_items:
+                    del self._user_items[user_id]
+
+    def reprioritize(self, user_id, subscription_type, reputation):
+        with self._lock:
+            for item_id in self._user_items.get(user_id, ()):
+                number_type, key, _ = self._items[item_id]
+                new_key = (-SUBSCRIPTION_PRIORITY.get(subscription_type, 0), -(reputation or 0)) + key[2:]
+                if new_key != key:
+                    self._by_type[number_type].remove(key)
+                    self._by_type[number_type].add(new_key)
+                    self._items[item_id] = (number_type, new_key, user_id)
+
+    def rank(self, item_id):
+        # Позиция номера в общей очереди (с 1)
+        with self._lock:
+            entry = self._items.get(item_id)
+            if entry is None:
+                return None
+            return self._position(entry[1])
+
+    def position(self, key):
+        # Позиция, которую занял бы ключ (номер мог уже уйти из очереди)
+        with self._lock:
+            return self._position(key)
+
+    def _position(self, key):
+        return 1 + sum(b.rank(key) for b in self._by_type.values())
+
+    def page(self, limit, after=None, before=None):
+        # До limit ключей общей очереди строго после after (или строго перед
+        # before — тогда от ближнего к дальнему)
+        with self._lock:
+            reverse = before is not None
+            lists = [b.irange(before if reverse else after, reverse) for b in self._by_type.values()]
+            return list(itertools.islice(heapq.merge(*lists, reverse=reverse), limit))
+
+    def pop(self, number_type, limit):
+        # Снимает до limit лучших номеров типа: разные операторы получают разные номера
+        with self._lock:
+            bucket = self._by_type.get(number_type)
+            entries = []
+            while bucket and len(entries) < limit:
+                key = bucket.first()
+                if key is None:
+                    break
+                bucket.remove(key)
+                item_id = key[-1]
+                _, _, user_id = self._items.pop(item_id)
+                user_items = self._user_items.get(user_id)
+                if user_items is not None:
+                    user_items.discard(item_id)
+                    if not user_items:
+                        del self._user_items[user_id]
+                entries.append((item_id, number_type, key, user_id))
+        return entries
+
+    def restore(self, entries):
+        with self._lock:
+            for item_id, number_type, key, user_id in entries:
+                if item_id in self._items:
+                    continue
+                self._by_type.setdefault(number_type, _SortedBuckets()).add(key)
+                self._items[item_id] = (number_type, key, user_id)
+                self._user_items.setdefault(user_id, set()).add(item_id)
+
+    def __len__(self):
+        return len(self._items)
+
+queue_index = QueueIndex()
+
+def claim_numbers(admin_id, number_type, limit=1):
+    # Номера резервируются в индексе (каждый достаётся одному оператору), затем
+    # одной короткой транзакцией переводятся из queued в taken. Строки, которые
+    # успели удалить из очереди, просто пропускаются.
+    entries = queue_index.pop(number_type, limit)
+    if not entries:
+        return []
+    claimed = []
+    try:
+        with db_transaction() as c:
+            now = datetime.now(tz)
+            for item_id, _, _, _ in entries:
+                row = c.execute("SELECT user_id, phone_number, type, added_time FROM numbers WHERE id = ? AND state = 'queued'", (item_id,)).fetchone()
+                if not row:
+                    continue
+                c.execute("UPDATE numbers SET state = 'taken', admin_id = ?, start_time = ? WHERE id = ?", (admin_id, now, item_id))
+                user_id, phone, row_type, added_time = row
+                note_queue_change(user_id, -1)
+                wait = (now - added_time).total_seconds() / 60 if added_time else None
+                record_rollup(c, user_id, row_type, 'taken', when=now, wait=wait)
+                claimed.append({'id': item_id, 'user_id': user_id, 'phone_number': phone, 'start_time': now, 'admin_id': admin_id, 'type': row_type})
+    except BaseException:
+        queue_index.restore(entries)
+        raise
+    return claimed
+
+def _reprioritize_user(user_id):
+    user = get_user(user_id)
+    if user:
+        queue_index.reprioritize(user_id, user['subscription_type'], user['reputation'])
+
+# Обслуживание по расписанию: истёкшие подписки, снятие 30-дневной блокировки
+# карты и просроченные счета. Каждая часть идёт пачками по индексу по сроку,
+# каждая пачка — отдельная короткая транзакция.
+SWEEP_INTERVAL = 5 * 60  # секунды
+SWEEP_BATCH = 500
+CARD_BLOCK_DAYS = 30
+PAYMENT_TTL_MINUTES = 120
+
+def _sweep_batches(select_sql, cutoff, apply):
+    total = 0
+    while True:
+        with db_transaction() as c:
+            ids = [row[0] for row in c.execute(select_sql, (cutoff, SWEEP_BATCH))]
+            if ids:
+                apply(c, ids)
+        total += len(ids)
+        if len(ids) < SWEEP_BATCH:
+            return total
+
+def _in_clause(ids):
+    return ', '.join('?' * len(ids))
+
+def _expire_subscriptions(c, ids):
+    c.execute(f"UPDATE users SET subscription_type = NULL, subscription_end = NULL WHERE id IN ({_in_clause(ids)})", ids)
+    invalidate_user(*ids)
+    for user_id in ids:
+        db_after_commit(lambda user_id=user_id: _reprioritize_user(user_id))
+
+def _unblock_cards(c, ids):
+    c.execute(f"UPDATE users SET card_status = 'inactive', block_reason = NULL WHERE id IN ({_in_clause(ids)})", ids)
+    invalidate_user(*ids)
+
+def _expire_payments(c, ids):
+    c.execute(f"UPDATE payments SET status = 'expired' WHERE id IN ({_in_clause(ids)}) AND status = 'pending'", ids)
+
+SWEEP_SUBSCRIPTIONS_SQL = hot_query('sweep_subscriptions', "SELECT id FROM users WHERE subscription_end <= ? LIMIT ?", ('', 0))
+SWEEP_CARD_BLOCKS_SQL = hot_query('sweep_card_blocks', "SELECT id FROM users WHERE card_status = 'blocked' AND block_reason = 'user' AND card_activation_date <= ? LIMIT ?", ('', 0))
+SWEEP_PAYMENTS_SQL = hot_query('sweep_payments', "SELECT id FROM payments WHERE status = 'pending' AND created_at <= ? LIMIT ?", ('', 0))
+
+def run_sweeper():
+    now = datetime.now(tz)
+    report = {
+        'subscriptions': _sweep_batches(SWEEP_SUBSCRIPTIONS_SQL, now, _expire_subscriptions),
+        'card_unblocks': _sweep_batches(SWEEP_CARD_BLOCKS_SQL, now - timedelta(days=CARD_BLOCK_DAYS), _unblock_cards),
+        'payments': _sweep_batches(SWEEP_PAYMENTS_SQL, now - timedelta(minutes=PAYMENT_TTL_MINUTES), _expire_payments),
+    }
+    if any(report.values()):
+        print(f"Sweeper: {report}")
+    return report
 
 def show_main_menu(chat_id, edit_message_id=None):
     clear_pending_step(chat_id)  # Очищаем pending при показе главного меню
@@ -457,8 +1850,8 @@ def show_main_menu(chat_id, edit_message_id=None):
     status = get_status('work_status')
     reputation = user['reputation']
     balance = user['balance']
-    queue_count = len(get_queue())
-    user_queue_count = len(get_user_queue(chat_id))
+    queue_count = queue_size()
+    user_queue_count = user_queue_size(chat_id)
     caption = f"@{username} | Full Work\n➢Статус ворка: {status}\n➣Репутация: {reputation}\n➢Баланс: {balance}\n╓Общая очередь: {queue_count}\n║\n╚Твои номера в очереди: {user_queue_count}"
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("Добавить номер 🚀", callback_data="add_number"), types.InlineKeyboardButton("Мои номера 📱", callback_data="my_numbers"))
@@ -485,15 +1878,20 @@ def handle_start(message):
     user = get_user(user_id)
     if not user:
         referral_code = generate_referral_code(user_id)
-        cursor.execute("INSERT INTO users (id, username, referral_code, last_activity, profit_level) VALUES (?, ?, ?, ?, ?)", (user_id, username, referral_code, datetime.now(tz), 'новичок'))
-        conn.commit()
+        db_execute("INSERT INTO users (id, username, referral_code, last_activity, profit_level) VALUES (?, ?, ?, ?, ?)", (user_id, username, referral_code, datetime.now(tz), 'новичок'))
         if ref:
             referer_id = int(ref[4:])
+            credited = False
             if referer_id != user_id:
-                cursor.execute("INSERT OR IGNORE INTO referrals (referer_id, referee_id) VALUES (?, ?)", (referer_id, user_id))
-                conn.commit()
-                referer = get_user(referer_id)
-                update_user(referer_id, balance=referer['balance'] + 0.5, referrals_count=referer['referrals_count'] + 1)
+                try:
+                    with db_transaction() as c:
+                        if c.execute("INSERT OR IGNORE INTO referrals (referer_id, referee_id) VALUES (?, ?)", (referer_id, user_id)).rowcount:
+                            ledger_post(c, referer_id, 0.5, 'referral_bonus', column='balance', contra=LEDGER_REFERRALS)
+                            c.execute("UPDATE users SET referrals_count = referrals_count + 1 WHERE id = ?", (referer_id,))
+                            credited = True
+                except LookupError:
+                    credited = False
+            if credited:
                 referrals = get_user(referer_id)['referrals_count']
                 profit = get_profit_level(referrals, is_admin=is_admin(referer_id))
                 update_user(referer_id, profit_level=profit)
@@ -546,94 +1944,360 @@ def add_number(call):
         caption = "Введите номер в формате +7XXXXXXXXXX"
     else:
         caption = "Введите номер в формате 9XXXXXXXXX"
+    caption += "\nИли пришлите файл .txt/.csv — по номеру в строке"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="add_number"))
     bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['add_number'], caption=caption), reply_markup=markup)
     register_next_step(call.message.chat.id, process_add_number, call.message.message_id, number_type)
 
+PHONE_FORMATS = {
+    'max': re.compile(r'\+7\d{10}'),
+    'vc': re.compile(r'9\d{9}'),
+}
+
+def valid_phone(phone, number_type):
+    pattern = PHONE_FORMATS.get(number_type)
+    return bool(pattern and pattern.fullmatch(phone))
+
+NUMBER_DUPLICATE_SQL = hot_query('number_duplicate', f"SELECT 1 FROM numbers WHERE phone_key = ? AND type = ? AND state IN ({_states_sql(LIVE_STATES)})", ('', ''))
+
 def process_add_number(message, message_id=None, number_type=None):
-    phone = message.text.strip()
-    if number_type == 'max':
-        if not re.match(r'\+7\d{10}', phone):
-            bot.send_message(message.chat.id, "Неверный формат. Попробуйте снова.")
-            add_number_type_choice(_SimpleNS(message=message, from_user=message.from_user, data="add_number"))
-            return
-    else:
-        if len(phone) != 10 or not phone.isdigit() or not phone.startswith('9'):
-            bot.send_message(message.chat.id, "Неверный формат. Попробуйте снова.")
-            add_number_type_choice(_SimpleNS(message=message, from_user=message.from_user, data="add_number"))
-            return
-    cursor.execute("SELECT * FROM queue WHERE phone_number = ?", (phone,))
-    if cursor.fetchone():
+    if getattr(message, 'document', None):
+        import_numbers(message, number_type)
+        return
+    phone = (message.text or "").strip()
+    if not valid_phone(phone, number_type):
+        bot.send_message(message.chat.id, "Неверный формат. Попробуйте снова.")
+        add_number_type_choice(_SimpleNS(message=message, from_user=message.from_user, data="add_number"))
+        return
+    user = get_user(message.chat.id)
+    added_time = datetime.now(tz)
+    with db_transaction() as c:
+        # Проверка дубля и вставка в одной транзакции: два одновременных
+        # добавления одного номера не пройдут проверку оба
+        duplicate = c.execute(NUMBER_DUPLICATE_SQL, (normalize_phone(phone), number_type)).fetchone()
+        if not duplicate:
+            item_id = c.execute("INSERT INTO numbers (user_id, phone_number, phone_key, type, state, added_time) VALUES (?, ?, ?, ?, 'queued', ?)", (message.chat.id, phone, normalize_phone(phone), number_type, added_time)).lastrowid
+            note_queue_change(message.chat.id, 1)
+            record_rollup(c, message.chat.id, number_type, 'added', when=added_time)
+            db_after_commit(lambda: queue_index.add(item_id, message.chat.id, number_type, added_time, user['subscription_type'], user['reputation']))
+    if duplicate:
         bot.send_message(message.chat.id, "Номер уже добавлен.")
         show_main_menu(message.chat.id)
         return
-    cursor.execute("INSERT INTO queue (user_id, phone_number, added_time, type) VALUES (?, ?, ?, ?)", (message.chat.id, phone, datetime.now(tz), number_type))
-    conn.commit()
     log_action(message.chat.id, f"Добавлен номер {phone} типа {number_type}")
     show_main_menu(message.chat.id)
 
+# Массовая загрузка: файл читается построчно, проверка формата — той же
+# valid_phone, дубли отсекаются одним запросом по json_each, вставка — одним
+# executemany в одной транзакции. В ответ — отчёт по каждой строке.
+IMPORT_MAX_BYTES = 1024 * 1024
+IMPORT_MAX_LINES = 5000
+IMPORT_REPORT_INLINE = 30
+
+def _read_import_lines(data, file_name):
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', errors='replace', newline='')
+    if file_name.endswith('.csv'):
+        for row in csv.reader(stream, delimiter=';' if ';' in data[:1024].decode('utf-8', 'ignore') else ','):
+            yield row
+    else:
+        for line in stream:
+            yield [line]
+
+def parse_import_file(data, file_name, number_type):
+    # Возвращает [(номер строки, номер, тип, причина отказа или None)]
+    results = []
+    seen = set()
+    for line_no, row in enumerate(_read_import_lines(data, file_name), 1):
+        if line_no > IMPORT_MAX_LINES:
+            results.append((line_no, '', number_type, f"лимит {IMPORT_MAX_LINES} строк"))
+            break
+        phone = row[0].strip() if row else ''
+        row_type = row[1].strip().lower() if len(row) > 1 and row[1].strip() else number_type
+        if not phone:
+            continue
+        # Повтор ищется по тому же ключу, что у уникального индекса очереди
+        # (нормализованный номер и тип), — отчёт совпадает с тем, что вставится
+        key = (normalize_phone(phone), row_type)
+        if not valid_phone(phone, row_type):
+            results.append((line_no, phone, row_type, "неверный формат"))
+        elif key in seen:
+            results.append((line_no, phone, row_type, "повтор в файле"))
+        else:
+            seen.add(key)
+            results.append((line_no, phone, row_type, None))
+    return results
+
+def import_numbers(message, number_type):
+    user_id = message.chat.id
+    document = message.document
+    file_name = (document.file_name or '').lower()
+    if not file_name.endswith(('.txt', '.csv')):
+        bot.send_message(user_id, "❌ Нужен файл .txt или .csv")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        bot.send_message(user_id, f"❌ Файл больше {IMPORT_MAX_BYTES // 1024} КБ")
+        return
+    data = bot.download_file(bot.get_file(document.file_id).file_path)
+    results = parse_import_file(data, file_name, number_type)
+    candidates = sorted({normalize_phone(phone) for _, phone, _, reason in results if reason is None})
+    user = get_user(user_id)
+    added_time = datetime.now(tz)
+    with db_transaction() as c:
+        taken = set(c.execute(f"SELECT phone_key, type FROM numbers WHERE phone_key IN (SELECT value FROM json_each(?)) AND state IN ({_states_sql(LIVE_STATES)})", (json.dumps(candidates),)).fetchall())
+        results = [(line_no, phone, row_type, "уже в очереди" if reason is None and (normalize_phone(phone), row_type) in taken else reason) for line_no, phone, row_type, reason in results]
+        accepted = [(user_id, phone, normalize_phone(phone), row_type, added_time) for _, phone, row_type, reason in results if reason is None]
+        first_id = c.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM numbers").fetchone()[0]
+        c.executemany("INSERT INTO numbers (user_id, phone_number, phone_key, type, state, added_time) VALUES (?, ?, ?, ?, 'queued', ?)", accepted)
+        if accepted:
+            rows = c.execute("SELECT id, type FROM numbers WHERE id >= ? AND user_id = ? AND state = 'queued'", (first_id, user_id)).fetchall()
+            note_queue_change(user_id, len(accepted))
+            for row_type in set(row[3] for row in accepted):
+                record_rollup(c, user_id, row_type, 'added', count=sum(1 for row in accepted if row[3] == row_type), when=added_time)
+
+            def index_rows():
+                for item_id, row_type in rows:
+                    queue_index.add(item_id, user_id, row_type, added_time, user['subscription_type'], user['reputation'])
+            db_after_commit(index_rows)
+    report = [f"{line_no}: {phone} — {reason or 'принят'}" for line_no, phone, _, reason in results]
+    summary = f"📄 Загрузка: принято {len(accepted)}, отклонено {len(results) - len(accepted)}"
+    if len(report) <= IMPORT_REPORT_INLINE:
+        bot.send_message(user_id, "\n".join([summary] + report))
+    else:
+        report_file = io.BytesIO("\n".join(report).encode('utf-8'))
+        report_file.name = "import_report.txt"
+        bot.send_document(user_id, report_file, caption=summary)
+    log_action(user_id, f"Загрузил файл {document.file_name}: принято {len(accepted)} номеров")
+    show_main_menu(user_id)
+
+# Постраничные списки. Страница выбирается по ключу сортировки (keyset), а не
+# через OFFSET: кнопки «назад/вперёд» несут граничную строку страницы в
+# callback_data вида pg:<список>:<n|p>:<курсор>. Каждая страница — один запрос
+# с LIMIT, так что её цена не зависит от длины списка.
+PAGE_SIZE = 10
+PAGED_LISTS = {}
+
+def paged_list(*names):
+    def decorator(func):
+        for name in names:
+            PAGED_LISTS[name] = func
+        return func
+    return decorator
+
+def _page_sql(page, with_cursor, direction):
+    descending = page['desc'] == (direction == 'n')
+    keys = ', '.join(page['order_by'])
+    sql = f"SELECT {page['columns']} FROM {page['table']} WHERE {page['where']}"
+    if with_cursor:
+        sql += f" AND ({keys}) {'<' if descending else '>'} (SELECT {keys} FROM {page['table']} WHERE id = ?)"
+    return sql + " ORDER BY " + ', '.join(f"{column} {'DESC' if descending else 'ASC'}" for column in page['order_by']) + " LIMIT ?"
+
+def page_query(name, table, where, sample, order_by, desc=False, columns='*'):
+    # order_by — колонки сортировки, последняя из них id; sample — образец
+    # параметров where. Первая страница и шаги от курсора в обе стороны
+    # регистрируются как горячие запросы.
+    page = {'table': table, 'where': where, 'order_by': order_by, 'desc': desc, 'columns': columns}
+    hot_query(name, _page_sql(page, False, 'n'), tuple(sample) + (0,))
+    for direction in ('n', 'p'):
+        hot_query(f"{name}:{direction}", _page_sql(page, True, direction), tuple(sample) + (0, 0))
+    return page
+
+def fetch_page(page, params, cursor=None, direction='n'):
+    # page — описание из page_query; курсор — id граничной строки
+    forward = direction == 'n'
+    args = list(params)
+    if cursor is not None:
+        args.append(cursor)
+    args.append(PAGE_SIZE + 1)
+    rows = db_fetchall_dicts(_page_sql(page, cursor is not None, direction), args)
+    if not rows and cursor is not None:
+        # Граничной строки уже нет — начинаем список сначала
+        return fetch_page(page, params)
+    more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if forward:
+        return rows, cursor is not None, more
+    rows.reverse()
+    return rows, more, True
+
+def add_page_buttons(markup, name, rows, has_prev, has_next, cursor_of=lambda row: row['id']):
+    buttons = []
+    if rows and has_prev:
+        buttons.append(types.InlineKeyboardButton("⬅️", callback_data=f"pg:{name}:p:{cursor_of(rows[0])}"))
+    if rows and has_next:
+        buttons.append(types.InlineKeyboardButton("➡️", callback_data=f"pg:{name}:n:{cursor_of(rows[-1])}"))
+    if buttons:
+        markup.row(*buttons)
+
+def _page_args(call):
+    # (имя списка, курсор, направление) для нажатия pg:..., иначе первая страница
+    if call.data.startswith("pg:"):
+        _, name, direction, cursor = call.data.split(":", 3)
+        return name, cursor, direction
+    return call.data, None, 'n'
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("pg:"))
+def show_page(call):
+    parts = call.data.split(":", 3)
+    if len(parts) != 4 or parts[1] not in PAGED_LISTS or parts[2] not in ('n', 'p'):
+        bot.answer_callback_query(call.id, "Неверный запрос")
+        return
+    PAGED_LISTS[parts[1]](call)
+
 @bot.callback_query_handler(func=lambda call: call.data == "my_numbers")
 def my_numbers(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     caption = "Мои номера"
+    counts = user_number_counts(call.message.chat.id)
     markup = types.InlineKeyboardMarkup(row_width=2)
-    markup.add(types.InlineKeyboardButton("В работе ⚙️", callback_data="my_working"), types.InlineKeyboardButton("Ожидает ⏳", callback_data="my_queue"))
-    markup.add(types.InlineKeyboardButton("Успешные ✅", callback_data="my_successful"), types.InlineKeyboardButton("Блок 🛑", callback_data="my_blocked"))
+    markup.add(types.InlineKeyboardButton(f"В работе ⚙️ ({counts['working']})", callback_data="my_working"), types.InlineKeyboardButton(f"Ожидает ⏳ ({counts['queue']})", callback_data="my_queue"))
+    markup.add(types.InlineKeyboardButton(f"Успешные ✅ ({counts['successful']})", callback_data="my_successful"), types.InlineKeyboardButton(f"Блок 🛑 ({counts['blocked']})", callback_data="my_blocked"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
     bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['my_numbers'], caption=caption), reply_markup=markup)
 
+MY_NUMBER_PAGES = {view: page_query(f"my_{view}", 'numbers', f"user_id = ? AND state IN ({', '.join('?' * len(states))})", (0,) + states, ('id',))
+                   for view, states in NUMBER_VIEWS.items()}
+
+@paged_list(*(f"my_{view}" for view in NUMBER_VIEWS))
 @bot.callback_query_handler(func=lambda call: call.data.startswith("my_"))
 def show_my_list(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
-    data = call.data
-    items = None
-    title = None
-    if data == "my_queue":
-        items = get_user_queue(call.message.chat.id)
-        title = "Ожидает"
-    elif data == "my_working":
-        items = get_working(call.message.chat.id)
-        title = "В работе"
-    elif data == "my_successful":
-        items = get_successful(call.message.chat.id)
-        title = "Успешные"
-    elif data == "my_blocked":
-        items = get_blocked(call.message.chat.id)
-        title = "Блок"
-    else:
+    name, cursor, direction = _page_args(call)
+    view = name[len("my_"):]
+    titles = {'queue': "Ожидает", 'working': "В работе", 'successful': "Успешные", 'blocked': "Блок"}
+    if view not in titles:
         bot.answer_callback_query(call.id, "Неверный запрос")
         return
+    items, has_prev, has_next = fetch_page(MY_NUMBER_PAGES[view], (call.message.chat.id,) + NUMBER_VIEWS[view],
+                                           cursor=int(cursor) if cursor else None, direction=direction)
+    if view == 'queue':
+        for item in items:
+            item['type'] = f"{item['type']}, место {queue_index.rank(item['id'])}"
+    title = titles[view]
     caption = f"{title}\n" + "\n".join(f"{item['phone_number']} ({item['type']})" for item in items) if items else f"{title}: Пусто"
     markup = types.InlineKeyboardMarkup()
+    add_page_buttons(markup, name, items, has_prev, has_next)
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="my_numbers"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
+def _queue_cursor(key):
+    return '_'.join(repr(part) for part in key)
+
+def _parse_queue_cursor(cursor):
+    priority, reputation, ts, item_id = cursor.split('_')
+    return (int(priority), float(reputation), float(ts), int(item_id))
+
+@paged_list('queue')
 @bot.callback_query_handler(func=lambda call: call.data == "queue")
 def show_queue(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     user = get_user(call.message.chat.id)
     sub = user['subscription_type']
+    markup = types.InlineKeyboardMarkup()
     if sub in ['Gold Tier', 'Prime Plus', 'VIP Nexus']:
-        queue = sort_queue(get_queue())
-        caption = "Очередь:\n" + "\n".join(f"{item['phone_number']} ({item['type']})" for item in queue) if queue else "Очередь пуста"
+        # Очередь живёт в памяти (queue_index), курсор — ключ граничного номера
+        _, cursor, direction = _page_args(call)
+        key = _parse_queue_cursor(cursor) if cursor else None
+        if direction == 'p':
+            keys = queue_index.page(PAGE_SIZE + 1, before=key)
+            has_prev, has_next = len(keys) > PAGE_SIZE, True
+            keys = keys[:PAGE_SIZE][::-1]
+        else:
+            keys = queue_index.page(PAGE_SIZE + 1, after=key)
+            has_prev, has_next = key is not None, len(keys) > PAGE_SIZE
+            keys = keys[:PAGE_SIZE]
+        items = {item['id']: item for item in get_queue_items([k[-1] for k in keys])}
+        keys = [k for k in keys if k[-1] in items]
+        if keys:
+            start = queue_index.position(keys[0])
+            caption = f"Очередь ({queue_size()}):\n" + "\n".join(f"{start + i}. {items[k[-1]]['phone_number']} ({items[k[-1]]['type']})" for i, k in enumerate(keys))
+        else:
+            caption = "Очередь пуста"
+        add_page_buttons(markup, 'queue', keys, has_prev, has_next, cursor_of=_queue_cursor)
     else:
-        caption = f"Общая очередь: {len(get_queue())}"
-    markup = types.InlineKeyboardMarkup()
+        caption = f"Общая очередь: {queue_size()}"
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data == "stats")
+# Экран статистики: фильтры по периоду и типу номера едут в callback_data
+# (st:<период>:<тип>), карточка воркера — st_w:<период>:<тип>:<id>.
+STATS_PERIODS = {'d': "Сегодня", 'w': "7 дней", 'm': "Месяц"}
+STATS_TYPES = ('all', 'vc', 'max')
+STATS_TOP = 10
+
+def _stats_range(period):
+    today = datetime.now(tz)
+    if period == 'w':
+        start = today - timedelta(days=6)
+    elif period == 'm':
+        start = today.replace(day=1)
+    else:
+        start = today
+    return rollup_day(start), rollup_day(today)
+
+def _fmt_minutes(value):
+    return '—' if value is None else f"{value} мин"
+
+def _stats_filter_buttons(markup, period, number_type):
+    markup.row(*(types.InlineKeyboardButton(("• " if p == period else "") + title, callback_data=f"st:{p}:{number_type}") for p, title in STATS_PERIODS.items()))
+    markup.row(*(types.InlineKeyboardButton(("• " if t == number_type else "") + ("все" if t == 'all' else t), callback_data=f"st:{period}:{t}") for t in STATS_TYPES))
+
+@bot.callback_query_handler(func=lambda call: call.data == "stats" or call.data.startswith("st:"))
 def show_stats(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     if not is_admin(call.from_user.id):
         bot.answer_callback_query(call.id, "Данная функция не доступна", show_alert=True)
         return
-    stats = get_successful()
-    caption = "Статистика:\n" + "\n".join(f"{get_user(item['user_id'])['username']}-{item['phone_number']} ({item['type']})-холд: {item['hold_time']}" for item in stats if item['hold_time'])
-    markup = types.InlineKeyboardMarkup()
+    _, period, number_type = call.data.split(":") if call.data.startswith("st:") else ("st", 'd', 'all')
+    if period not in STATS_PERIODS or number_type not in STATS_TYPES:
+        bot.answer_callback_query(call.id, "Неверный запрос")
+        return
+    start_day, end_day = _stats_range(period)
+    type_filter = None if number_type == 'all' else number_type
+    summary = cached_stats(('summary', start_day, end_day, type_filter), lambda: rollup_summary(start_day, end_day, type_filter))
+    workers = cached_stats(('workers', start_day, end_day, type_filter), lambda: worker_stats(start_day, end_day, type_filter))
+    lines = [f"Статистика: {STATS_PERIODS[period]}, тип: {'все' if number_type == 'all' else number_type}",
+             f"Добавлено {summary['added']}, взято {summary['taken']}, успешно {summary['successful']}, блок {summary['blocked']}, снято {summary['dropped']}, удалено {summary['removed']}",
+             f"Ожидание: медиана {_fmt_minutes(summary['median_wait'])}, p90 {_fmt_minutes(summary['p90_wait'])}",
+             f"Холд: всего {summary['hold_minutes'] / 60:.1f} ч, медиана {_fmt_minutes(summary['median_hold'])}, p90 {_fmt_minutes(summary['p90_hold'])}",
+             f"Воркеров: {len(workers)}" + (f", ниже топ-{STATS_TOP} по успешным" if len(workers) > STATS_TOP else ""),
+             "Табель: /export, сводка по дням: /export daily"]
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for worker in workers[:STATS_TOP]:
+        name = f"@{worker['username']}" if worker['username'] else str(worker['user_id'])
+        markup.add(types.InlineKeyboardButton(f"{name}: ✅ {worker['successful']}, 🛑 {worker['blocked']}, {worker['hold_minutes'] / 60:.1f} ч",
+                                              callback_data=f"st_w:{period}:{number_type}:{worker['user_id']}"))
+    _stats_filter_buttons(markup, period, number_type)
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="back_main"))
-    bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    bot.edit_message_caption("\n".join(lines), call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("st_w:"))
+def show_worker_stats(call):
+    clear_pending_step(call.message.chat.id)
+    if not is_admin(call.from_user.id):
+        bot.answer_callback_query(call.id, "Данная функция не доступна", show_alert=True)
+        return
+    _, period, number_type, user_id = call.data.split(":")
+    if period not in STATS_PERIODS or number_type not in STATS_TYPES:
+        bot.answer_callback_query(call.id, "Неверный запрос")
+        return
+    user_id = int(user_id)
+    start_day, end_day = _stats_range(period)
+    type_filter = None if number_type == 'all' else number_type
+    summary = cached_stats(('worker', user_id, start_day, end_day, type_filter), lambda: rollup_summary(start_day, end_day, type_filter, user_id))
+    days = cached_stats(('worker_days', user_id, start_day, end_day, type_filter), lambda: worker_days(user_id, start_day, end_day, type_filter))
+    user = get_user(user_id)
+    name = f"@{user['username']}" if user and user['username'] else str(user_id)
+    lines = [f"👤 {name} ({user_id}) — {STATS_PERIODS[period]}, тип: {'все' if number_type == 'all' else number_type}",
+             f"Добавлено {summary['added']}, взято {summary['taken']}, успешно {summary['successful']}, блок {summary['blocked']}, снято {summary['dropped']}, удалено {summary['removed']}",
+             f"Ожидание: медиана {_fmt_minutes(summary['median_wait'])}, p90 {_fmt_minutes(summary['p90_wait'])}",
+             f"Холд: всего {summary['hold_minutes'] / 60:.1f} ч, медиана {_fmt_minutes(summary['median_hold'])}, p90 {_fmt_minutes(summary['p90_hold'])}"]
+    if days:
+        lines.append("По дням:")
+        lines += [f"{day['day']}: +{day['added']}, ✅ {day['successful']}, 🛑 {day['blocked']}, холд {day['hold_minutes'] / 60:.1f} ч" for day in days]
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data=f"st:{period}:{number_type}"))
+    bot.edit_message_caption("\n".join(lines), call.message.chat.id, call.message.message_id, reply_markup=markup)
 
 @bot.callback_query_handler(func=lambda call: call.data == "profile")
 def show_profile(call):
@@ -702,41 +2366,41 @@ def process_check_amount(message, message_id):
     process_create_check(message.chat.id, amount, message_id)
 
 def process_create_check(user_id, amount, message_id):
-    user = get_user(user_id)
-    balance = user['card_balance']
-    if amount < 1 or amount > balance:
+    unique_code = str(uuid.uuid4())
+    try:
+        if amount < 1:
+            raise InsufficientFunds(user_id)
+        with db_transaction() as c:
+            ledger_post(c, user_id, -amount, 'check_create', contra=LEDGER_CHECKS)
+            check_id = c.execute("INSERT INTO checks (creator_id, amount, unique_code) VALUES (?, ?, ?)", (user_id, amount, unique_code)).lastrowid
+    except InsufficientFunds:
         bot.send_message(user_id, "❌ Сумма должна быть от 1$ до вашего баланса.")
         create_check(_SimpleNS(data="create_check", message=_SimpleNS(chat=_SimpleNS(id=user_id), message_id=message_id), from_user=_SimpleNS(id=user_id)))
         return
-    unique_code = str(uuid.uuid4())
-    cursor.execute("INSERT INTO checks (creator_id, amount, unique_code) VALUES (?, ?, ?)", (user_id, amount, unique_code))
-    conn.commit()
-    check_id = cursor.lastrowid
-    update_user(user_id, card_balance=balance - amount)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -amount, datetime.now(tz), 'check_create'))
-    conn.commit()
     show_check_options(user_id, check_id, message_id)
 
 def show_check_options(chat_id, check_id, edit_id=None):
     clear_pending_step(chat_id)
-    cursor.execute("SELECT * FROM checks WHERE id = ?", (check_id,))
-    check = cursor.fetchone()
-    if not check:
+    check_dict = db_fetchone_dict("SELECT * FROM checks WHERE id = ?", (check_id,))
+    if not check_dict:
         bot.send_message(chat_id, "❌ Чек не найден.")
         return
-    columns = [desc[0] for desc in cursor.description]
-    check_dict = dict(zip(columns, check))
     amount = check_dict['amount']
     unique_code = check_dict['unique_code']
-    link = f"https://t.me/{bot.get_me().username}?start=check_{unique_code}"
+    link = bot_link(f"check_{unique_code}")
     description = check_dict['description'] or "Отсутствует"
     password = "Да" if check_dict['password'] else "Нет"
     image = "Да" if check_dict['image_file_id'] else "Нет"
     subs = json.loads(check_dict['require_subs'] or "[]")
     subs_status = "Вкл" if subs else "Выкл"
     premium_status = "Вкл" if check_dict['require_premium'] else "Выкл"
-    caption = f"🧾 Мой чек\n💰 Сумма чека: {amount}$\n🔗 Ссылка на активацию чека: {link}"
+    limit = check_dict['activation_limit']
+    caption = f"🧾 Мой чек\n💰 Сумма чека: {amount}$"
+    if limit > 1:
+        caption += f" × {limit} активаций (активировано: {check_dict['activations_count']})"
+    caption += f"\n🔗 Ссылка на активацию чека: {link}"
     markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(types.InlineKeyboardButton(f"👥 Количество активаций: {limit}", callback_data=f"set_limit_{check_id}"))
     markup.add(types.InlineKeyboardButton("📝 Добавить описание", callback_data=f"add_desc_{check_id}"))
     markup.add(types.InlineKeyboardButton("🔑 Добавить пароль", callback_data=f"add_pass_{check_id}"))
     markup.add(types.InlineKeyboardButton("🖼️ Добавить картинку", callback_data=f"add_image_{check_id}"))
@@ -751,6 +2415,47 @@ def show_check_options(chat_id, check_id, edit_id=None):
     else:
         bot.send_message(chat_id, caption, reply_markup=markup)
 
+MAX_CHECK_ACTIVATIONS = 10000
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("set_limit_"))
+def set_limit(call):
+    clear_pending_step(call.message.chat.id)
+    check_id = int(call.data.split("_")[2])
+    caption = f"👥 Пришлите количество активаций чека (от 1 до {MAX_CHECK_ACTIVATIONS}).\nКаждая активация получает сумму чека, разница спишется с баланса карты или вернётся на него."
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data=f"show_check_{check_id}"))
+    bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    register_next_step(call.message.chat.id, process_set_limit, check_id, call.message.message_id)
+
+def process_set_limit(message, check_id, message_id):
+    text = (message.text or "").strip()
+    if not text.isdigit() or not 1 <= int(text) <= MAX_CHECK_ACTIVATIONS:
+        bot.send_message(message.chat.id, "❌ Неверное количество. Попробуйте снова.")
+        register_next_step(message.chat.id, process_set_limit, check_id, message_id)
+        return
+    new_limit = int(text)
+    try:
+        with db_transaction() as c:
+            row = c.execute("SELECT creator_id, amount, activation_limit, activations_count FROM checks WHERE id = ?", (check_id,)).fetchone()
+            valid = row and row[0] == message.chat.id and new_limit >= max(row[3], 1)
+            if valid and new_limit != row[2]:
+                ledger_post(c, row[0], -row[1] * (new_limit - row[2]), 'check_limit', contra=LEDGER_CHECKS)
+                c.execute("UPDATE checks SET activation_limit = ? WHERE id = ?", (new_limit, check_id))
+    except InsufficientFunds:
+        bot.send_message(message.chat.id, "❌ Недостаточно средств на карте.")
+        return
+    if not row or row[0] != message.chat.id:
+        bot.send_message(message.chat.id, "❌ Чек не найден.")
+        return
+    count = row[3]
+    if not valid:
+        bot.send_message(message.chat.id, f"❌ Чек уже активировали {count} раз.")
+        return
+    if new_limit > count:
+        _exhausted_checks.discard(check_id)
+    bot.send_message(message.chat.id, "✅ Количество активаций изменено.")
+    show_check_options(message.chat.id, check_id, message_id)
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("add_desc_"))
 def add_desc(call):
     clear_pending_step(call.message.chat.id)
@@ -763,8 +2468,7 @@ def add_desc(call):
 
 def process_add_desc(message, check_id, message_id):
     description = message.text
-    cursor.execute("UPDATE checks SET description = ? WHERE id = ?", (description, check_id))
-    conn.commit()
+    db_execute("UPDATE checks SET description = ? WHERE id = ?", (description, check_id))
     bot.send_message(message.chat.id, "✅ Описание добавлено.")
     show_check_options(message.chat.id, check_id, message_id)
 
@@ -791,8 +2495,7 @@ def confirm_pass(call):
     parts = call.data.split("_")
     check_id = int(parts[2])
     password = "_".join(parts[3:])  # if password has _
-    cursor.execute("UPDATE checks SET password = ? WHERE id = ?", (password, check_id))
-    conn.commit()
+    db_execute("UPDATE checks SET password = ? WHERE id = ?", (password, check_id))
     bot.answer_callback_query(call.id, "✅ Пароль установлен.")
     show_check_options(call.message.chat.id, check_id, call.message.message_id)
 
@@ -812,8 +2515,7 @@ def process_add_image(message, check_id, message_id):
         add_image(_SimpleNS(data=f"add_image_{check_id}", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user))
         return
     file_id = message.photo[-1].file_id
-    cursor.execute("UPDATE checks SET image_file_id = ? WHERE id = ?", (file_id, check_id))
-    conn.commit()
+    db_execute("UPDATE checks SET image_file_id = ? WHERE id = ?", (file_id, check_id))
     bot.send_message(message.chat.id, "✅ Картинка добавлена.")
     show_check_options(message.chat.id, check_id, message_id)
 
@@ -854,36 +2556,33 @@ def process_add_sub(message, check_id, message_id):
         bot.send_message(message.chat.id, "❌ Неверная ссылка.")
         added_bot_subs(_SimpleNS(data=f"added_bot_subs_{check_id}", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user))
         return
-    cursor.execute("SELECT require_subs FROM checks WHERE id = ?", (check_id,))
-    subs_json = cursor.fetchone()[0] or "[]"
-    subs = json.loads(subs_json)
-    subs.append({"name": name, "url": url, "channel": channel})
-    cursor.execute("UPDATE checks SET require_subs = ? WHERE id = ?", (json.dumps(subs), check_id))
-    conn.commit()
+    with db_transaction() as c:
+        subs_json = c.execute("SELECT require_subs FROM checks WHERE id = ?", (check_id,)).fetchone()[0] or "[]"
+        subs = json.loads(subs_json)
+        subs.append({"name": name, "url": url, "channel": channel})
+        c.execute("UPDATE checks SET require_subs = ? WHERE id = ?", (json.dumps(subs), check_id))
     bot.send_message(message.chat.id, "✅ Подписка добавлена.")
     show_check_options(message.chat.id, check_id, message_id)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("toggle_premium_"))
 def toggle_premium(call):
     check_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT require_premium FROM checks WHERE id = ?", (check_id,))
-    current = cursor.fetchone()[0]
-    new = 1 if current == 0 else 0
-    cursor.execute("UPDATE checks SET require_premium = ? WHERE id = ?", (new, check_id))
-    conn.commit()
+    with db_transaction() as c:
+        current = c.execute("SELECT require_premium FROM checks WHERE id = ?", (check_id,)).fetchone()[0]
+        new = 1 if current == 0 else 0
+        c.execute("UPDATE checks SET require_premium = ? WHERE id = ?", (new, check_id))
     bot.answer_callback_query(call.id, f"⭐ Функция только для Premium {'включена' if new else 'выключена'}.")
     show_check_options(call.message.chat.id, check_id, call.message.message_id)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("share_check_"))
 def share_check(call):
     check_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT amount, unique_code FROM checks WHERE id = ?", (check_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT amount, unique_code FROM checks WHERE id = ?", (check_id,))
     if not row:
         bot.answer_callback_query(call.id, "❌ Чек не найден.")
         return
     amount, unique_code = row
-    link = f"https://t.me/{bot.get_me().username}?start=check_{unique_code}"
+    link = bot_link(f"check_{unique_code}")
     caption = f"🦋 Чек на {amount} USDT 🪙"
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("Получить ✅", url=link))
@@ -893,30 +2592,55 @@ def share_check(call):
 @bot.callback_query_handler(func=lambda call: call.data.startswith("qr_check_"))
 def qr_check(call):
     check_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT unique_code FROM checks WHERE id = ?", (check_id,))
-    unique_code = cursor.fetchone()[0]
-    link = f"https://t.me/{bot.get_me().username}?start=check_{unique_code}"
-    qr_url = f"https://quickchart.io/qr?text={requests.utils.quote(link)}&size=200"
-    bot.send_photo(call.message.chat.id, qr_url)
+    row = db_fetchone("SELECT unique_code, qr_file_id FROM checks WHERE id = ?", (check_id,))
+    if not row:
+        bot.answer_callback_query(call.id, "❌ Чек не найден.")
+        return
+    unique_code, qr_file_id = row
+    # После первой загрузки картинка переотправляется по file_id Telegram
+    if qr_file_id:
+        bot.send_photo(call.message.chat.id, qr_file_id)
+    else:
+        sent = bot.send_photo(call.message.chat.id, check_qr_photo(unique_code))
+        if sent and sent.photo:
+            db_execute("UPDATE checks SET qr_file_id = ? WHERE id = ?", (sent.photo[-1].file_id, check_id))
     bot.answer_callback_query(call.id, "🔲 QR-код для чека.")
 
+@lru_cache(maxsize=256)
+def render_check_qr(unique_code):
+    image = qrcode.make(bot_link(f"check_{unique_code}"), box_size=8, border=2)
+    buf = io.BytesIO()
+    image.save(buf, format='PNG')
+    return buf.getvalue()
+
+def check_qr_photo(unique_code):
+    if qrcode is None:
+        return f"https://quickchart.io/qr?text={requests.utils.quote(bot_link(f'check_{unique_code}'))}&size=200"
+    photo = io.BytesIO(render_check_qr(unique_code))
+    photo.name = f"check_{unique_code}.png"
+    return photo
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("delete_check_"))
 def delete_check(call):
     check_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT creator_id, amount, activated_at FROM checks WHERE id = ?", (check_id,))
-    row = cursor.fetchone()
+    # Возвращается остаток за неиспользованные активации; частично активированный чек закрывается
+    with db_transaction() as c:
+        row = c.execute("SELECT creator_id, amount, activation_limit, activations_count FROM checks WHERE id = ?", (check_id,)).fetchone()
+        remaining = row[2] - row[3] if row else 0
+        if remaining > 0:
+            creator_id, amount, _, count = row
+            if count:
+                c.execute("UPDATE checks SET activation_limit = activations_count WHERE id = ?", (check_id,))
+            else:
+                c.execute("DELETE FROM checks WHERE id = ?", (check_id,))
+            ledger_post(c, creator_id, amount * remaining, 'check_delete', contra=LEDGER_CHECKS)
+            db_after_commit(lambda: _exhausted_checks.add(check_id))
     if not row:
         bot.answer_callback_query(call.id, "❌ Чек не найден.")
         return
-    creator_id, amount, activated_at = row
-    if activated_at:
+    if remaining <= 0:
         bot.answer_callback_query(call.id, "❌ Чек уже активирован, нельзя удалить.")
         return
-    user = get_user(creator_id)
-    update_user(creator_id, card_balance=user['card_balance'] + amount)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (creator_id, amount, datetime.now(tz), 'check_delete'))
-    cursor.execute("DELETE FROM checks WHERE id = ?", (check_id,))
-    conn.commit()
     bot.answer_callback_query(call.id, "🗑️ Чек удален, средства возвращены.")
     create_check_menu(call)
 
@@ -925,15 +2649,14 @@ def show_check(call):
     check_id = int(call.data.split("_")[2])
     show_check_options(call.message.chat.id, check_id, call.message.message_id)
 
+CHECK_BY_CODE_SQL = hot_query('check_by_code', "SELECT * FROM checks WHERE unique_code = ?", ('',))
+
 def handle_check_activation(message, unique_code):
-    cursor.execute("SELECT * FROM checks WHERE unique_code = ?", (unique_code,))
-    row = cursor.fetchone()
-    if not row:
+    check = db_fetchone_dict(CHECK_BY_CODE_SQL, (unique_code,))
+    if not check:
         bot.send_message(message.chat.id, "❌ Чек не найден.")
         return
-    columns = [desc[0] for desc in cursor.description]
-    check = dict(zip(columns, row))
-    if check['activated_at']:
+    if check['id'] in _exhausted_checks or check['activations_count'] >= check['activation_limit']:
         bot.send_message(message.chat.id, "❌ Этот чек уже активирован.")
         return
     user_id = message.from_user.id
@@ -969,22 +2692,11 @@ def handle_check_activation(message, unique_code):
 @bot.callback_query_handler(func=lambda call: call.data.startswith("check_subs_activate_"))
 def check_subs_activate(call):
     check_id = int(call.data.split("_")[3])
-    cursor.execute("SELECT require_subs, password FROM checks WHERE id = ?", (check_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT require_subs, password FROM checks WHERE id = ?", (check_id,))
     require_subs = json.loads(row[0] or "[]")
     password = row[1]
     user_id = call.from_user.id
-    all_subbed = True
-    for sub in require_subs:
-        try:
-            member = bot.get_chat_member(f"@{sub['channel']}", user_id)
-            if member.status not in ['member', 'administrator', 'creator']:
-                all_subbed = False
-                break
-        except:
-            all_subbed = False
-            break
-    if not all_subbed:
+    if not is_member_of_all((f"@{sub['channel']}" for sub in require_subs), user_id):
         bot.answer_callback_query(call.id, "❌ Вы не подписаны на все каналы. Подпишитесь и попробуйте снова.")
         return
     if password:
@@ -996,30 +2708,53 @@ def check_subs_activate(call):
 
 def process_activate_password(message, check_id):
     password = message.text
-    cursor.execute("SELECT password FROM checks WHERE id = ?", (check_id,))
-    correct = cursor.fetchone()[0]
+    correct = db_fetchone("SELECT password FROM checks WHERE id = ?", (check_id,))[0]
     if password != correct:
         bot.send_message(message.chat.id, "❌ Неверный пароль. Попробуйте снова.")
         register_next_step(message.chat.id, process_activate_password, check_id)
         return
     activate_check(message.chat.id, check_id)
 
+# Исчерпанные чеки запоминаются в памяти: при массовой активации проигравшие
+# отсекаются без запросов к БД. Сама активация — один условный UPDATE счётчика,
+# поэтому лишней активации или повторной для того же пользователя быть не может.
+_exhausted_checks = set()
+
+CHECK_ACTIVATED_SQL = hot_query('check_activation_exists', "SELECT 1 FROM check_activations WHERE check_id = ? AND user_id = ?", (0, 0))
+
 def activate_check(user_id, check_id):
-    cursor.execute("SELECT creator_id, amount, activated_at FROM checks WHERE id = ?", (check_id,))
-    row = cursor.fetchone()
-    if row[2]:  # activated_at
+    if check_id in _exhausted_checks:
         bot.send_message(user_id, "❌ Чек уже активирован.")
-        return
-    creator_id, amount = row[0], row[1]
-    user = get_user(user_id)
-    update_user(user_id, card_balance=user['card_balance'] + amount)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, amount, datetime.now(tz), 'check_activate'))
-    cursor.execute("UPDATE checks SET activated_by = ?, activated_at = ? WHERE id = ?", (user_id, datetime.now(tz), check_id))
-    conn.commit()
-    activator_username = user['username']
+        return False
+    now = datetime.now(tz)
+    with db_transaction() as c:
+        rows = c.execute('''
+        UPDATE checks SET activations_count = activations_count + 1, activated_by = ?, activated_at = ?
+        WHERE id = ? AND activations_count < activation_limit
+          AND NOT EXISTS (SELECT 1 FROM check_activations WHERE check_id = ? AND user_id = ?)
+        RETURNING creator_id, amount, activations_count, activation_limit
+        ''', (user_id, now, check_id, check_id, user_id)).fetchall()
+        if rows:
+            creator_id, amount, count, limit = rows[0]
+            c.execute("INSERT INTO check_activations (check_id, user_id, amount, activated_at) VALUES (?, ?, ?, ?)", (check_id, user_id, amount, now))
+            ledger_post(c, user_id, amount, 'check_activate', contra=LEDGER_CHECKS)
+    if not rows:
+        if db_fetchone(CHECK_ACTIVATED_SQL, (check_id, user_id)):
+            bot.send_message(user_id, "❌ Вы уже активировали этот чек.")
+        else:
+            _exhausted_checks.add(check_id)
+            bot.send_message(user_id, "❌ Чек уже активирован.")
+        return False
+    if count >= limit:
+        _exhausted_checks.add(check_id)
+    activator_username = get_user(user_id)['username']
     creator_username = get_user(creator_id)['username']
     bot.send_message(user_id, f"✅ Вы активировали чек от @{creator_username} и получили {amount} USDT 🪙.")
-    bot.send_message(creator_id, f"✅ @{activator_username} активировал ваш чек и получил {amount} USDT 🪙.")
+    text = f"✅ @{activator_username} активировал ваш чек и получил {amount} USDT 🪙."
+    if limit > 1:
+        text += f"\nАктиваций: {count}/{limit}"
+    notify(creator_id, text)
+    return True
 
 @bot.callback_query_handler(func=lambda call: call.data == "buy_sub")
 def buy_sub(call):
@@ -1089,10 +2824,8 @@ def sub_stars(call):
         bot.answer_callback_query(call.id, "Ошибка: подписка не найдена", show_alert=True)
         return
     payload = f"sub_{sub_type}_{call.from_user.id}_{random.randint(1, 1000000)}"
-    cursor.execute("INSERT INTO payments (user_id, sub_type, amount, payload) VALUES (?, ?, ?, ?)",
-                   (call.from_user.id, sub_type, price, payload))
-    conn.commit()
-    payment_id = cursor.lastrowid
+    payment_id = db_execute("INSERT INTO payments (user_id, sub_type, amount, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                            (call.from_user.id, sub_type, price, payload, datetime.now(tz))).lastrowid
     caption = f"💸 Оплатите счёт\n— Способ: 🌟 Telegram stars 🌟\n— Сумма: {price} Stars"
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("Оплатить", callback_data=f"pay_stars_inv_{payment_id}"))
@@ -1104,8 +2837,7 @@ def sub_stars(call):
 def pay_stars_inv(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     payment_id = int(call.data.split("_")[3])
-    cursor.execute("SELECT sub_type, payload, amount FROM payments WHERE id = ?", (payment_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT sub_type, payload, amount FROM payments WHERE id = ?", (payment_id,))
     if row:
         sub_type, payload, amount = row
         prices_list = [types.LabeledPrice(label=f"Оплата подписки {sub_type}", amount=int(amount))]
@@ -1124,8 +2856,7 @@ def pay_stars_inv(call):
 def check_stars(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     payment_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT status FROM payments WHERE id = ?", (payment_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT status FROM payments WHERE id = ?", (payment_id,))
     if row and row[0] == 'paid':
         bot.answer_callback_query(call.id, "Оплата подтверждена! Подписка активирована.")
     else:
@@ -1172,10 +2903,8 @@ def sub_crypto(call):
                 pay_url = invoice['pay_url']
 
                 # Сохраняем в БД
-                cursor.execute("INSERT INTO payments (user_id, sub_type, amount, invoice_id) VALUES (?, ?, ?, ?)",
-                               (call.from_user.id, sub_type, price, invoice_id))
-                conn.commit()
-                payment_id = cursor.lastrowid
+                payment_id = db_execute("INSERT INTO payments (user_id, sub_type, amount, invoice_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                                        (call.from_user.id, sub_type, price, invoice_id, datetime.now(tz))).lastrowid
 
                 caption = f"💸 Оплатите счёт\n— Способ: 🌐CryptoBot🌐\n— Сумма: {price} USDT"
                 markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1200,8 +2929,7 @@ def check_crypto(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     try:
         payment_id = int(call.data.split("_")[2])
-        cursor.execute("SELECT invoice_id FROM payments WHERE id = ?", (payment_id,))
-        row = cursor.fetchone()
+        row = db_fetchone("SELECT invoice_id FROM payments WHERE id = ?", (payment_id,))
         if not row:
             bot.answer_callback_query(call.id, "Инвойс не найден", show_alert=True)
             return
@@ -1222,14 +2950,14 @@ def check_crypto(call):
                 if invoices:
                     status = invoices[0]['status']
                     if status == 'paid':
-                        cursor.execute("SELECT user_id, sub_type FROM payments WHERE id = ? AND status = 'pending'", (payment_id,))
-                        row = cursor.fetchone()
+                        with db_transaction() as c:
+                            row = c.execute(f"SELECT user_id, sub_type FROM payments WHERE id = ? AND status IN {PAYABLE_STATUSES}", (payment_id,)).fetchone()
+                            if row:
+                                user_id, sub_type = row
+                                end = datetime.now(tz) + timedelta(days=30)
+                                c.execute("UPDATE payments SET status = 'paid' WHERE id = ?", (payment_id,))
+                                update_user(user_id, subscription_type=sub_type, subscription_end=end)
                         if row:
-                            user_id, sub_type = row
-                            end = datetime.now(tz) + timedelta(days=30)
-                            update_user(user_id, subscription_type=sub_type, subscription_end=end)
-                            cursor.execute("UPDATE payments SET status = 'paid' WHERE id = ?", (payment_id,))
-                            conn.commit()
                             bot.answer_callback_query(call.id, "Оплата подтверждена! Подписка активирована.")
                             bot.send_message(call.message.chat.id, f"Подписка {sub_type} активирована на 30 дней.")
                         else:
@@ -1263,24 +2991,18 @@ def successful_payment(message):
         user_id = int(parts[2])
         if user_id == message.from_user.id:
             end = datetime.now(tz) + timedelta(days=30)
-            update_user(user_id, subscription_type=sub_type, subscription_end=end)
-            cursor.execute("UPDATE payments SET status = 'paid', transaction_id = ? WHERE payload = ?", (message.successful_payment.telegram_payment_charge_id, payload))
-            conn.commit()
+            with db_transaction() as c:
+                update_user(user_id, subscription_type=sub_type, subscription_end=end)
+                c.execute("UPDATE payments SET status = 'paid', transaction_id = ? WHERE payload = ?", (message.successful_payment.telegram_payment_charge_id, payload))
             bot.send_message(message.chat.id, f"Подписка {sub_type} активирована!")
     elif payload.startswith('deposit_'):
-        cursor.execute("SELECT id, user_id, amount FROM payments WHERE payload = ? AND sub_type = 'deposit' AND status = 'pending'", (payload,))
-        row = cursor.fetchone()
+        row = db_fetchone(DEPOSIT_BY_PAYLOAD_SQL, (payload,))
         if row:
             payment_id, user_id, amount = row
             if user_id == message.from_user.id:
-                cursor.execute("UPDATE payments SET status = 'paid', transaction_id = ? WHERE id = ?", (message.successful_payment.telegram_payment_charge_id, payment_id))
-                conn.commit()
                 deposit_amount = amount / 2  # 2 stars = 1$
-                user = get_user(user_id)
-                update_user(user_id, card_balance=user['card_balance'] + deposit_amount)
-                cursor.execute("INSERT INTO deposit_history (user_id, amount, created_at, request_id) VALUES (?, ?, ?, ?)",
-                               (user_id, deposit_amount, datetime.now(tz), payment_id))
-                conn.commit()
+                if not credit_deposit(payment_id, user_id, deposit_amount, message.successful_payment.telegram_payment_charge_id):
+                    return
                 bot.send_message(message.chat.id, f"Счет пополнен на {deposit_amount}$!")
                 # Возвращаем в карту
                 display_card(message.chat.id, message.message_id)
@@ -1295,7 +3017,7 @@ def show_referral(call):
     user = get_user(call.message.chat.id)
     referrals = user['referrals_count']
     balance = user['balance']
-    ref_link = f"https://t.me/{bot.get_me().username}?start={user['referral_code']}"
+    ref_link = bot_link(user['referral_code'])
     caption = f"💎 Реферальная система\n\n<blockquote>📔 Наша реферальная система позволит вам заработать крупную сумму без вложений. \nДостаточно давать свою ссылку друзьям — и от каждой покупки вашего реферала вы будете получать 0.5$ на свой баланс.</blockquote>\n\n🔗 Ссылка: {ref_link}\n\n💰 Заработано: {balance}$\n\n👤 Рефералов: {referrals}"
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(types.InlineKeyboardButton("Создать заявку 💸", callback_data="withdraw"), types.InlineKeyboardButton("Мои заявки 📋", callback_data="requests_list"))
@@ -1303,17 +3025,21 @@ def show_referral(call):
     markup.row(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
     bot.edit_message_media(chat_id=call.message.chat.id, message_id=call.message.message_id, media=types.InputMediaPhoto(photos.PHOTOS['referral'], caption=caption, parse_mode='HTML'), reply_markup=markup)
 
+DEPOSIT_HISTORY_PAGE = page_query('show_deposit_history', 'withdraw_requests', "user_id = ? AND status = 'paid'", (0,), ('paid_at', 'id'), desc=True)
+
+@paged_list('deposit_history')
 @bot.callback_query_handler(func=lambda call: call.data == "deposit_history")
 def show_deposit_history(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     user_id = call.from_user.id
-    cursor.execute("SELECT id, amount, paid_at FROM withdraw_requests WHERE user_id = ? AND status = 'paid' ORDER BY paid_at DESC", (user_id,))
-    requests = cursor.fetchall()
+    _, cursor, direction = _page_args(call)
+    requests, has_prev, has_next = fetch_page(DEPOSIT_HISTORY_PAGE, (user_id,), cursor=int(cursor) if cursor else None, direction=direction)
     caption = "История зачислений:"
     markup = types.InlineKeyboardMarkup(row_width=1)
     if requests:
         for req in requests:
-            markup.add(types.InlineKeyboardButton(f"🖥️{req[1]}$", callback_data=f"view_deposit_{req[0]}"))
+            markup.add(types.InlineKeyboardButton(f"🖥️{req['amount']}$", callback_data=f"view_deposit_{req['id']}"))
+        add_page_buttons(markup, 'deposit_history', requests, has_prev, has_next)
     else:
         caption += "\n\nНет зачислений"
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="referral"))
@@ -1323,8 +3049,7 @@ def show_deposit_history(call):
 def view_deposit(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     req_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT amount, paid_at, id FROM withdraw_requests WHERE id = ? AND user_id = ?", (req_id, call.from_user.id))
-    req = cursor.fetchone()
+    req = db_fetchone("SELECT amount, paid_at, id FROM withdraw_requests WHERE id = ? AND user_id = ?", (req_id, call.from_user.id))
     if not req:
         bot.answer_callback_query(call.id, "Заявка не найдена", show_alert=True)
         return
@@ -1334,17 +3059,21 @@ def view_deposit(call):
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="deposit_history"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
+MY_REQUESTS_PAGE = page_query('show_my_requests', 'withdraw_requests', "user_id = ? AND status = 'pending'", (0,), ('id',), desc=True)
+
+@paged_list('requests_list')
 @bot.callback_query_handler(func=lambda call: call.data == "requests_list")
 def show_my_requests(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     user_id = call.from_user.id
-    cursor.execute("SELECT id, amount, status, created_at FROM withdraw_requests WHERE user_id = ? AND status = 'pending' ORDER BY id DESC", (user_id,))
-    requests = cursor.fetchall()
+    _, cursor, direction = _page_args(call)
+    requests, has_prev, has_next = fetch_page(MY_REQUESTS_PAGE, (user_id,), cursor=int(cursor) if cursor else None, direction=direction)
     caption = "Мои заявки:"
     markup = types.InlineKeyboardMarkup(row_width=1)
     if requests:
         for req in requests:
-            markup.add(types.InlineKeyboardButton(f"🖥️ Заявка №{req[0]:06d}", callback_data=f"view_request_{req[0]}"))
+            markup.add(types.InlineKeyboardButton(f"🖥️ Заявка №{req['id']:06d}", callback_data=f"view_request_{req['id']}"))
+        add_page_buttons(markup, 'requests_list', requests, has_prev, has_next)
     else:
         caption += "\n\nНет заявок"
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="referral"))
@@ -1354,8 +3083,7 @@ def show_my_requests(call):
 def view_request(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     req_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT * FROM withdraw_requests WHERE id = ?", (req_id,))
-    req = cursor.fetchone()
+    req = db_fetchone("SELECT * FROM withdraw_requests WHERE id = ?", (req_id,))
     if not req or req[1] != call.from_user.id:
         bot.answer_callback_query(call.id, "Заявка не найдена", show_alert=True)
         return
@@ -1391,25 +3119,23 @@ def process_edit_amount(message, message_id, req_id):
         fake_call = _SimpleNS(data=f"view_request_{req_id}", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user)
         view_request(fake_call)
         return
-    cursor.execute("SELECT amount, user_id FROM withdraw_requests WHERE id = ?", (req_id,))
-    row = cursor.fetchone()
+    try:
+        with db_transaction() as c:
+            row = c.execute("SELECT amount, user_id FROM withdraw_requests WHERE id = ? AND status = 'pending'", (req_id,)).fetchone()
+            if row:
+                old_amount, user_id = row
+                diff = new_amount - old_amount
+                if diff != 0:
+                    ledger_post(c, user_id, -diff, 'withdraw_request_edit', column='balance', contra=LEDGER_WITHDRAWALS)  # - negative = +
+                c.execute("UPDATE withdraw_requests SET amount = ? WHERE id = ?", (new_amount, req_id))
+    except InsufficientFunds:
+        bot.send_message(message.chat.id, "Недостаточно средств")
+        fake_call = _SimpleNS(data=f"view_request_{req_id}", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user)
+        view_request(fake_call)
+        return
     if not row:
         bot.send_message(message.chat.id, "Заявка не найдена")
         return
-    old_amount, user_id = row
-    user = get_user(user_id)
-    diff = new_amount - old_amount
-    if diff > 0:
-        if user['balance'] < diff:
-            bot.send_message(message.chat.id, "Недостаточно средств")
-            fake_call = _SimpleNS(data=f"view_request_{req_id}", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user)
-            view_request(fake_call)
-            return
-        update_user(user_id, balance=user['balance'] - diff)
-    elif diff < 0:
-        update_user(user_id, balance=user['balance'] - diff)  # - negative = +
-    cursor.execute("UPDATE withdraw_requests SET amount = ? WHERE id = ?", (new_amount, req_id))
-    conn.commit()
     bot.send_message(message.chat.id, "Сумма изменена")
     fake_call = _SimpleNS(data=f"view_request_{req_id}", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user)
     view_request(fake_call)
@@ -1418,16 +3144,14 @@ def process_edit_amount(message, message_id, req_id):
 def close_request(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     req_id = int(call.data.split("_")[2])
-    cursor.execute("SELECT amount, user_id, status FROM withdraw_requests WHERE id = ?", (req_id,))
-    row = cursor.fetchone()
-    if not row or row[2] != 'pending':
+    with db_transaction() as c:
+        row = c.execute("SELECT amount, user_id FROM withdraw_requests WHERE id = ? AND status = 'pending'", (req_id,)).fetchone()
+        if row:
+            c.execute("UPDATE withdraw_requests SET status = 'closed' WHERE id = ?", (req_id,))
+            ledger_post(c, row[1], row[0], 'withdraw_request_close', column='balance', contra=LEDGER_WITHDRAWALS)
+    if not row:
         bot.answer_callback_query(call.id, "Заявка не может быть закрыта", show_alert=True)
         return
-    amount, user_id = row[0], row[1]
-    user = get_user(user_id)
-    update_user(user_id, balance=user['balance'] + amount)
-    cursor.execute("UPDATE withdraw_requests SET status = 'closed' WHERE id = ?", (req_id,))
-    conn.commit()
     bot.answer_callback_query(call.id, "Заявка закрыта")
     show_my_requests(call)
 
@@ -1452,15 +3176,17 @@ def process_withdraw(message, message_id):
         fake_call = _SimpleNS(data="referral", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user)
         show_referral(fake_call)
         return
-    user = get_user(message.chat.id)
-    if amount > user['balance'] or amount < 50:
+    try:
+        if amount < 50:
+            raise InsufficientFunds(message.chat.id)
+        with db_transaction() as c:
+            ledger_post(c, message.chat.id, -amount, 'withdraw_request', column='balance', contra=LEDGER_WITHDRAWALS)
+            c.execute("INSERT INTO withdraw_requests (user_id, amount, created_at) VALUES (?, ?, ?)", (message.chat.id, amount, datetime.now(tz)))
+    except InsufficientFunds:
         bot.send_message(message.chat.id, "Недостаточно средств или ниже минимума")
         fake_call = _SimpleNS(data="referral", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user)
         show_referral(fake_call)
         return
-    cursor.execute("INSERT INTO withdraw_requests (user_id, amount, created_at) VALUES (?, ?, ?)", (message.chat.id, amount, datetime.now(tz)))
-    conn.commit()
-    update_user(message.chat.id, balance=user['balance'] - amount)
     bot.send_message(message.chat.id, "Заявка создана")
     fake_call = _SimpleNS(data="referral", message=_SimpleNS(chat=_SimpleNS(id=message.chat.id), message_id=message_id), from_user=message.from_user)
     show_referral(fake_call)
@@ -1479,16 +3205,13 @@ def show_card(call):
             bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
             return
         elif user['block_reason'] == 'user':
-            if user['card_activation_date'] and (datetime.now(tz) - user['card_activation_date']) >= timedelta(days=30):
-                update_user(call.message.chat.id, card_status='inactive', block_reason=None)
-                user = get_user(call.message.chat.id)  # Reload user
-            else:
-                remaining = timedelta(days=30) - (datetime.now(tz) - user['card_activation_date'])
-                caption = f"Карта заблокирована на 30 дней. Осталось: {remaining.days} дней"
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
-                bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
-                return
+            # Блокировку снимает run_sweeper
+            remaining = timedelta(days=CARD_BLOCK_DAYS) - (datetime.now(tz) - user['card_activation_date'])
+            caption = f"Карта заблокирована на {CARD_BLOCK_DAYS} дней. Осталось: {max(remaining.days, 0)} дней"
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="profile"))
+            bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
+            return
 
     if user['card_status'] == 'inactive':
         markup = types.InlineKeyboardMarkup()
@@ -1591,10 +3314,8 @@ def process_deposit_stars(message, message_id):
         deposit_stars(fake_call)
         return
     payload = f"deposit_{message.chat.id}_{random.randint(1, 1000000)}"
-    cursor.execute("INSERT INTO payments (user_id, sub_type, amount, payload) VALUES (?, ?, ?, ?)",
-                   (message.chat.id, 'deposit', stars_amount, payload))
-    conn.commit()
-    payment_id = cursor.lastrowid
+    payment_id = db_execute("INSERT INTO payments (user_id, sub_type, amount, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                            (message.chat.id, 'deposit', stars_amount, payload, datetime.now(tz))).lastrowid
     created_at = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
     caption = f"🏦 Способ оплаты: ⭐ Telegram Stars\n💰 Стоимость: {stars_amount} Stars\n📅 Создан: {created_at}\n⏰ Произведите оплату в течение 120 минут."
     markup = types.InlineKeyboardMarkup(row_width=2)
@@ -1607,8 +3328,7 @@ def process_deposit_stars(message, message_id):
 def pay_deposit_stars(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     payment_id = int(call.data.split("_")[3])
-    cursor.execute("SELECT payload, amount FROM payments WHERE id = ? AND sub_type = 'deposit'", (payment_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT payload, amount FROM payments WHERE id = ? AND sub_type = 'deposit'", (payment_id,))
     if row:
         payload, amount = row
         prices_list = [types.LabeledPrice(label="Пополнение счета", amount=int(amount))]
@@ -1626,8 +3346,7 @@ def pay_deposit_stars(call):
 def check_deposit_stars(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     payment_id = int(call.data.split("_")[3])
-    cursor.execute("SELECT status FROM payments WHERE id = ? AND sub_type = 'deposit'", (payment_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT status FROM payments WHERE id = ? AND sub_type = 'deposit'", (payment_id,))
     if row and row[0] == 'paid':
         bot.answer_callback_query(call.id, "Оплата подтверждена! Счет пополнен.")
         display_card(call.message.chat.id, call.message.message_id)
@@ -1683,10 +3402,8 @@ def process_deposit_crypto(message, message_id):
             invoice_id = invoice['invoice_id']
             pay_url = invoice['pay_url']
 
-            cursor.execute("INSERT INTO payments (user_id, sub_type, amount, invoice_id, payload) VALUES (?, ?, ?, ?, ?)",
-                           (message.chat.id, 'deposit', usdt_amount, invoice_id, payload))
-            conn.commit()
-            payment_id = cursor.lastrowid
+            payment_id = db_execute("INSERT INTO payments (user_id, sub_type, amount, invoice_id, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                    (message.chat.id, 'deposit', usdt_amount, invoice_id, payload, datetime.now(tz))).lastrowid
 
             created_at = datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')
             caption = f"🏦 Способ оплаты: 🌐 Crypto Bot\n💰 Стоимость: {usdt_amount} USDT\n📅 Создан: {created_at}\n⏰ Произведите оплату в течение 120 минут."
@@ -1704,8 +3421,7 @@ def process_deposit_crypto(message, message_id):
 def check_deposit_crypto(call):
     clear_pending_step(call.message.chat.id)  # Очищаем pending
     payment_id = int(call.data.split("_")[3])
-    cursor.execute("SELECT invoice_id, status FROM payments WHERE id = ? AND sub_type = 'deposit'", (payment_id,))
-    row = cursor.fetchone()
+    row = db_fetchone("SELECT invoice_id, status FROM payments WHERE id = ? AND sub_type = 'deposit'", (payment_id,))
     if not row:
         bot.answer_callback_query(call.id, "Инвойс не найден", show_alert=True)
         return
@@ -1726,15 +3442,10 @@ def check_deposit_crypto(call):
         if data.get('ok'):
             invoices = data['result']['items']
             if invoices and invoices[0]['status'] == 'paid':
-                cursor.execute("UPDATE payments SET status = 'paid' WHERE id = ?", (payment_id,))
-                conn.commit()
-                cursor.execute("SELECT user_id, amount FROM payments WHERE id = ?", (payment_id,))
-                user_id, amount = cursor.fetchone()
-                user = get_user(user_id)
-                update_user(user_id, card_balance=user['card_balance'] + (amount / 1))  # 1:1 для crypto
-                cursor.execute("INSERT INTO deposit_history (user_id, amount, created_at, request_id) VALUES (?, ?, ?, ?)",
-                               (user_id, amount, datetime.now(tz), payment_id))
-                conn.commit()
+                user_id, amount = db_fetchone("SELECT user_id, amount FROM payments WHERE id = ?", (payment_id,))
+                if not credit_deposit(payment_id, user_id, amount / 1):  # 1:1 для crypto
+                    bot.answer_callback_query(call.id, "Оплата уже подтверждена", show_alert=True)
+                    return
                 bot.answer_callback_query(call.id, "Оплата подтверждена! Счет пополнен.")
                 display_card(call.message.chat.id, call.message.message_id)
             else:
@@ -1749,19 +3460,13 @@ def check_deposit_crypto(call):
 def successful_payment(message):
     clear_pending_step(message.chat.id)  # Очищаем pending
     payload = message.successful_payment.invoice_payload
-    cursor.execute("SELECT id, user_id, amount FROM payments WHERE payload = ? AND sub_type = 'deposit' AND status = 'pending'", (payload,))
-    row = cursor.fetchone()
+    row = db_fetchone(DEPOSIT_BY_PAYLOAD_SQL, (payload,))
     if row:
         payment_id, user_id, amount = row
         if user_id == message.from_user.id:
-            cursor.execute("UPDATE payments SET status = 'paid', transaction_id = ? WHERE id = ?", (message.successful_payment.telegram_payment_charge_id, payment_id))
-            conn.commit()
             deposit_amount = amount / 2  # 2 stars = 1$
-            user = get_user(user_id)
-            update_user(user_id, card_balance=user['card_balance'] + deposit_amount)
-            cursor.execute("INSERT INTO deposit_history (user_id, amount, created_at, request_id) VALUES (?, ?, ?, ?)",
-                           (user_id, deposit_amount, datetime.now(tz), payment_id))
-            conn.commit()
+            if not credit_deposit(payment_id, user_id, deposit_amount, message.successful_payment.telegram_payment_charge_id):
+                return
             bot.send_message(message.chat.id, f"Счет пополнен на {deposit_amount}$!")
             # Возвращаем в карту
             display_card(message.chat.id, message.message_id)
@@ -1777,6 +3482,8 @@ def transfer_money(call):
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
     register_next_step(call.message.chat.id, process_transfer_money, call.message.message_id)
 
+USER_BY_USERNAME_SQL = hot_query('transfer_username', "SELECT id FROM users WHERE username = ?", ('',))
+
 def process_transfer_money(message, message_id):
     text = message.text.split()
     if len(text) != 2 or not text[1].replace('.', '', 1).isdigit():
@@ -1790,8 +3497,7 @@ def process_transfer_money(message, message_id):
         bot.send_message(message.chat.id, "Недостаточно средств или неверная сумма")
         card_settings(_SimpleNS(message=message, from_user=message.from_user, data="card_settings"))
         return
-    cursor.execute("SELECT id FROM users WHERE username = ?", (to_username,))
-    row = cursor.fetchone()
+    row = db_fetchone(USER_BY_USERNAME_SQL, (to_username,))
     if not row:
         bot.send_message(message.chat.id, "Пользователь не найден")
         card_settings(_SimpleNS(message=message, from_user=message.from_user, data="card_settings"))
@@ -1822,16 +3528,14 @@ def confirm_transfer(call):
     if to_user_id == from_user_id:
         bot.answer_callback_query(call.id, "Нельзя переводить деньги самому себе", show_alert=True)
         return
-    if amount > from_user['card_balance']:
+    try:
+        if amount <= 0:
+            raise InsufficientFunds(from_user_id)
+        with db_transaction() as c:
+            ledger_transfer(c, from_user_id, to_user_id, amount)
+    except (InsufficientFunds, LookupError):
         bot.answer_callback_query(call.id, "Недостаточно средств", show_alert=True)
         return
-    to_user = get_user(to_user_id)
-    update_user(from_user_id, card_balance=from_user['card_balance'] - amount)
-    update_user(to_user_id, card_balance=to_user['card_balance'] + amount)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (from_user_id, -amount, datetime.now(tz), 'transfer_out'))
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (to_user_id, amount, datetime.now(tz), 'transfer_in'))
-    cursor.execute("INSERT INTO transfers (from_user_id, to_user_id, amount, timestamp) VALUES (?, ?, ?, ?)", (from_user_id, to_user_id, amount, datetime.now(tz)))
-    conn.commit()
     # Notify receiver
     notify_caption = f"Зачисление денежных средств\nЮзернейм: {from_user['username']}\nСумма: {amount}\nДата: {datetime.now(tz).strftime('%Y-%m-%d %H:%M:%S')}"
     bot.send_message(to_user_id, notify_caption)
@@ -1839,38 +3543,72 @@ def confirm_transfer(call):
     # Return to card display without check photo
     display_card(call.message.chat.id, call.message.message_id)
 
+# Имя второй стороны перевода — по counterparty_id в том же запросе
+CARD_HISTORY_PAGE = page_query('card_history_user', 'card_history', "user_id = ?", (0,), ('timestamp', 'id'), desc=True,
+                               columns="*, (SELECT username FROM users WHERE users.id = card_history.counterparty_id) AS counterparty")
+
+@paged_list('card_history_user')
 @bot.callback_query_handler(func=lambda call: call.data == "card_history_user")
 def card_history_user(call):
     user_id = call.from_user.id
-    cursor.execute("SELECT amount, timestamp, type, id FROM card_history WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-    rows = cursor.fetchall()
+    _, cursor, direction = _page_args(call)
+    rows, has_prev, has_next = fetch_page(CARD_HISTORY_PAGE, (user_id,), cursor=int(cursor) if cursor else None, direction=direction)
     if not rows:
         caption = "Нет истории"
     else:
         caption = "История операций:"
     markup = types.InlineKeyboardMarkup()
     for row in rows:
-        if row[2] in ['deposit', 'transfer_in']:
-            sign = '+'
-        else:
-            sign = '-'
-        dt = row[1] if not isinstance(row[1], str) else datetime.fromisoformat(row[1])
-        if row[2] == 'transfer_in':
-            cursor.execute("SELECT from_user_id FROM transfers WHERE to_user_id=? AND amount=? AND timestamp=?", (user_id, row[0], row[1]))
-            tr = cursor.fetchone()
-            other = get_user(tr[0])['username'] if tr else ''
-            text = f"{sign}{abs(row[0])} {dt.strftime('%Y-%m-%d %H:%M')} от {other}"
-        elif row[2] == 'transfer_out':
-            cursor.execute("SELECT to_user_id FROM transfers WHERE from_user_id=? AND amount=? AND timestamp=?", (user_id, -row[0], row[1]))
-            tr = cursor.fetchone()
-            other = get_user(tr[0])['username'] if tr else ''
-            text = f"{sign}{abs(row[0])} {dt.strftime('%Y-%m-%d %H:%M')} кому {other}"
+        sign = '+' if row['amount'] >= 0 else '-'
+        dt = row['timestamp'] if not isinstance(row['timestamp'], str) else datetime.fromisoformat(row['timestamp'])
+        if row['type'] == 'transfer_in':
+            text = f"{sign}{abs(row['amount'])} {dt.strftime('%Y-%m-%d %H:%M')} от {row['counterparty'] or ''}"
+        elif row['type'] == 'transfer_out':
+            text = f"{sign}{abs(row['amount'])} {dt.strftime('%Y-%m-%d %H:%M')} кому {row['counterparty'] or ''}"
         else:
-            text = f"{sign}{abs(row[0])} {dt.strftime('%Y-%m-%d %H:%M')} {row[2]}"
-        markup.add(types.InlineKeyboardButton(text, callback_data=f"dummy_history_{row[3]}"))
+            text = f"{sign}{abs(row['amount'])} {dt.strftime('%Y-%m-%d %H:%M')} {row['type']}"
+        markup.add(types.InlineKeyboardButton(text, callback_data=f"dummy_history_{row['id']}"))
+    add_page_buttons(markup, 'card_history_user', rows, has_prev, has_next)
+    markup.add(types.InlineKeyboardButton("Выписки 🗓", callback_data="card_statements"))
     markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card_settings"))
     bot.edit_message_caption(caption, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
+@bot.callback_query_handler(func=lambda call: call.data == "card_statements")
+def card_statements_menu(call):
+    month = datetime.now(tz).strftime('%Y-%m')
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    months = []
+    for _ in range(STATEMENT_MONTHS):
+        if not statement_available(month):
+            break
+        months.append(month)
+        month = _previous_month(month)
+    markup.add(*(types.InlineKeyboardButton(m, callback_data=f"card_statement_{m}") for m in months))
+    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card_history_user"))
+    bot.edit_message_caption("🗓 Выберите месяц", call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("card_statement_"))
+def show_card_statement(call):
+    try:
+        month = _month_bounds(call.data[len("card_statement_"):])[0].strftime('%Y-%m')
+    except ValueError:
+        bot.answer_callback_query(call.id, "Неверный запрос")
+        return
+    statement = card_statement(call.from_user.id, month)
+    if statement is None:
+        bot.answer_callback_query(call.id, f"Выписки доступны с {ledger_started_at().strftime('%m.%Y')}", show_alert=True)
+        return
+    lines = [f"🗓 Выписка за {month}" + (" (месяц не закрыт)" if month >= datetime.now(tz).strftime('%Y-%m') else ""),
+             f"Остаток на начало: {statement['opening']}$",
+             f"Поступления: +{statement['credits']}$",
+             f"Списания: {statement['debits']}$",
+             f"Остаток на конец: {statement['closing']}$",
+             f"Операций: {statement['operations']}"]
+    lines += [f"  {kind}: {count} на {total:+}$" for kind, (count, total) in sorted(statement['by_type'].items())]
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Назад 🔙", callback_data="card_statements"))
+    bot.edit_message_caption("\n".join(lines), call.message.chat.id, call.message.message_id, reply_markup=markup)
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("dummy_history_"))
 def dummy_history(call):
     bot.answer_callback_query(call.id, "Информация об операции", show_alert=False)
@@ -1911,12 +3649,11 @@ def block_card(call):
 @bot.callback_query_handler(func=lambda call: call.data == "confirm_block_card")
 def confirm_block_card(call):
     user_id = call.from_user.id
-    user = get_user(user_id)
-    balance = user['card_balance']
-    if balance > 0:
-        cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -balance, datetime.now(tz), 'withdraw'))
-        conn.commit()
-    update_user(user_id, card_status='blocked', block_reason='user', card_balance=0, card_activation_date=datetime.now(tz))
+    with db_transaction() as c:
+        balance = c.execute("SELECT card_balance FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+        if balance > 0:
+            ledger_post(c, user_id, -balance, 'withdraw')
+        update_user(user_id, card_status='blocked', block_reason='user', card_activation_date=datetime.now(tz))
     bot.edit_message_caption("Карта заблокирована, баланс списан", call.message.chat.id, call.message.message_id)
     show_card(call)
 
@@ -1940,6 +3677,362 @@ def reset_api(call):
 
 
 
+@bot.message_handler(commands=['take'])
+def take_numbers(message):
+    clear_pending_step(message.chat.id)
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()
+    number_type = args[1] if len(args) > 1 else 'vc'
+    limit = int(args[2]) if len(args) > 2 and args[2].isdigit() else 1
+    if number_type not in ('vc', 'max') or not 1 <= limit <= 50:
+        bot.send_message(message.chat.id, "Формат /take vc|max [количество до 50]")
+        return
+    claimed = claim_numbers(message.from_user.id, number_type, limit)
+    if not claimed:
+        bot.send_message(message.chat.id, "Очередь пуста")
+        return
+    bot.send_message(message.chat.id, f"Взято в работу: {len(claimed)}")
+    for item in claimed:
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(types.InlineKeyboardButton("Запросить код 📲", callback_data=f"wk_req_{item['id']}"), types.InlineKeyboardButton("Блок 🛑", callback_data=f"wk_block_{item['id']}"))
+        bot.send_message(message.chat.id, f"{item['phone_number']} ({item['type']}) от {item['user_id']}", reply_markup=markup)
+    log_admin_action(message.from_user.id, f"Взял в работу {len(claimed)} номеров {number_type}")
+
+# Работа с номером: оператор запрашивает код, у владельца есть окно активации,
+# чтобы нажать «Ввёл» или «Скип». После «Встал» идёт холд: по достижении
+# MIN_HOLD_MINUTES стороны получают уведомление, по HOLD_LIMIT_MINUTES номер сам
+# уходит в успешные. Переходы — условные UPDATE по статусу, поэтому повторные
+# нажатия и гонка кнопки с таймером безопасны.
+ACTIVATION_WINDOW = 120
+HOLD_LIMIT_MINUTES = int(getattr(config, 'HOLD_LIMIT_MINUTES', 24 * 60))
+
+def finish_working(working_id, outcome, expected_status=None):
+    # outcome: 'successful', 'blocked' или 'dropped' (номер просто снимается)
+    with db_transaction() as c:
+        row = c.execute(f"SELECT user_id, phone_number, type, admin_id, state, accepted_at FROM numbers WHERE id = ? AND state IN ({_states_sql(WORKING_STATES)})", (working_id,)).fetchone()
+        if not row or (expected_status and row[4] != expected_status):
+            return None
+        user_id, phone, number_type, admin_id, state, accepted_at = row
+        flight_time = datetime.now(tz)
+        if outcome == 'successful':
+            hold_time = calculate_hold(accepted_at, flight_time) if accepted_at else None
+            hold_minutes = (flight_time - accepted_at).total_seconds() / 60 if accepted_at else None
+            c.execute("""
+                UPDATE numbers SET state = 'successful', flight_time = ?, hold_time = ?, hold_minutes = ?,
+                    sub_type = (SELECT subscription_type FROM users WHERE users.id = numbers.user_id)
+                WHERE id = ?""", (flight_time, hold_time, hold_minutes, working_id))
+            record_rollup(c, user_id, number_type, 'successful', when=flight_time, hold=hold_minutes)
+        else:
+            c.execute("UPDATE numbers SET state = ?, flight_time = ? WHERE id = ?", (outcome, flight_time, working_id))
+            record_rollup(c, user_id, number_type, outcome, when=flight_time)
+        scheduler.cancel(f"activation:{working_id}")
+        scheduler.cancel(f"hold:{working_id}")
+    return {'user_id': user_id, 'phone_number': phone, 'type': number_type, 'admin_id': admin_id}
+
+def _working_markup(working_id, *buttons):
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*(types.InlineKeyboardButton(text, callback_data=f"wk_{action}_{working_id}") for text, action in buttons))
+    return markup
+
+@timer_handler('activation')
+def _activation_expired(working_id):
+    item = finish_working(working_id, 'dropped', expected_status='code_requested')
+    if item:
+        bot.send_message(item['user_id'], f"⌛ Время на ввод кода для {item['phone_number']} вышло, номер снят.")
+        bot.send_message(item['admin_id'], f"⌛ {item['phone_number']}: код не введён, номер снят.")
+
+@timer_handler('hold_min')
+def _hold_reached(working_id):
+    row = db_fetchone("SELECT user_id, phone_number, admin_id FROM numbers WHERE id = ? AND state = 'accepted'", (working_id,))
+    if not row:
+        return
+    user_id, phone, admin_id = row
+    scheduler.schedule(f"hold:{working_id}", 'hold_limit', (HOLD_LIMIT_MINUTES - MIN_HOLD_MINUTES) * 60, working_id)
+    bot.send_message(user_id, f"✅ {phone} отстоял {MIN_HOLD_MINUTES} мин — холд засчитан.")
+    bot.send_message(admin_id, f"✅ {phone}: холд {MIN_HOLD_MINUTES} мин достигнут.")
+
+@timer_handler('hold_limit')
+def _hold_limit(working_id):
+    item = finish_working(working_id, 'successful', expected_status='accepted')
+    if item:
+        bot.send_message(item['user_id'], f"✅ {item['phone_number']} отработал {HOLD_LIMIT_MINUTES // 60} ч и перенесён в успешные.")
+        bot.send_message(item['admin_id'], f"✅ {item['phone_number']}: лимит холда, перенесён в успешные.")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("wk_"))
+def working_action(call):
+    _, action, working_id = call.data.split("_")
+    working_id = int(working_id)
+    actor = call.from_user.id
+    owner_actions = ('done', 'skip')
+    if action not in owner_actions and not is_admin(actor):
+        bot.answer_callback_query(call.id, "Данная функция не доступна", show_alert=True)
+        return
+    row = db_fetchone(f"SELECT user_id, phone_number, admin_id FROM numbers WHERE id = ? AND state IN ({_states_sql(WORKING_STATES)})", (working_id,))
+    if not row or (action in owner_actions and row[0] != actor):
+        bot.answer_callback_query(call.id, "Номер уже не в работе")
+        return
+    user_id, phone, admin_id = row
+    if action == 'req':
+        with db_transaction() as c:
+            ok = c.execute("UPDATE numbers SET state = 'code_requested' WHERE id = ? AND state = 'taken'", (working_id,)).rowcount
+            if ok:
+                scheduler.schedule(f"activation:{working_id}", 'activation', ACTIVATION_WINDOW, working_id)
+        if ok:
+            bot.send_message(user_id, f"📲 Оператор запросил код для {phone}. У вас {ACTIVATION_WINDOW // 60} мин.", reply_markup=_working_markup(working_id, ("Ввёл ✅", 'done'), ("Скип ⏭", 'skip')))
+    elif action == 'done':
+        with db_transaction() as c:
+            ok = c.execute("UPDATE numbers SET state = 'code_entered' WHERE id = ? AND state = 'code_requested'", (working_id,)).rowcount
+            if ok:
+                scheduler.cancel(f"activation:{working_id}")
+        if ok:
+            bot.send_message(admin_id, f"🔑 {phone}: код введён.", reply_markup=_working_markup(working_id, ("Встал ✅", 'acc'), ("Блок 🛑", 'block')))
+    elif action == 'skip':
+        ok = finish_working(working_id, 'dropped', expected_status='code_requested')
+        if ok:
+            bot.send_message(admin_id, f"⏭ {phone}: владелец пропустил, номер снят.")
+    elif action == 'acc':
+        with db_transaction() as c:
+            ok = c.execute("UPDATE numbers SET state = 'accepted', accepted_at = ? WHERE id = ? AND state = 'code_entered'", (datetime.now(tz), working_id)).rowcount
+            if ok:
+                scheduler.schedule(f"hold:{working_id}", 'hold_min', MIN_HOLD_MINUTES * 60, working_id)
+        if ok:
+            bot.send_message(actor, f"⏱ {phone}: холд пошёл.", reply_markup=_working_markup(working_id, ("Слетел ✈️", 'fly'), ("Блок 🛑", 'block')))
+    elif action == 'fly':
+        ok = finish_working(working_id, 'successful', expected_status='accepted')
+        if ok:
+            bot.send_message(user_id, f"✈️ {phone} слетел, холд записан.")
+    elif action == 'block':
+        ok = finish_working(working_id, 'blocked')
+        if ok:
+            bot.send_message(user_id, f"🛑 {phone} заблокирован.")
+    else:
+        ok = False
+    bot.answer_callback_query(call.id, "Готово" if ok else "Действие уже недоступно")
+    if ok and action in owner_actions:
+        log_action(actor, f"Номер {phone}: {action}")
+    elif ok:
+        log_admin_action(actor, f"Номер {phone}: {action}")
+
+# Табель холдов: строки идут курсором прямо в файл (CSV или XLSX в режиме
+# write_only), так что память не растёт с числом строк.
+EXPORT_HEADER = ["Юзернейм", "ID", "Номер", "Тип", "Встал", "Слетел", "Холд"]
+
+def _hold_rows_sql(number_type=None):
+    return f"""
+        SELECT n.user_id, u.username, n.phone_number, n.type, n.accepted_at, n.flight_time, n.hold_time
+        FROM numbers n LEFT JOIN users u ON u.id = n.user_id
+        WHERE n.state = 'successful' AND n.flight_time >= ? AND n.flight_time < ?{' AND n.type = ?' if number_type else ''}
+        ORDER BY n.flight_time"""
+
+hot_query('export_holds', _hold_rows_sql(), ('', ''))
+hot_query('export_holds:type', _hold_rows_sql('vc'), ('', '', ''))
+
+def iter_hold_rows(start, end, number_type=None):
+    params = [start, end] + ([number_type] if number_type else [])
+    for user_id, username, phone, row_type, accepted, flight, hold in get_conn().execute(_hold_rows_sql(number_type), params):
+        yield [username or '', user_id, phone, row_type,
+               accepted.strftime('%Y-%m-%d %H:%M') if accepted else '',
+               flight.strftime('%Y-%m-%d %H:%M') if flight else '', hold or '']
+
+DAILY_EXPORT_HEADER = ["День", "Юзернейм", "ID", "Тип", "Добавлено", "Взято", "Успешно", "Блок", "Снято", "Удалено", "Ср. ожидание, мин", "Ср. холд, мин"]
+
+def iter_daily_rows(start, end, number_type=None):
+    sql = """
+        SELECT d.day, u.username, d.user_id, d.type, d.added, d.taken, d.successful, d.blocked, d.dropped, d.removed, d.wait_minutes, d.hold_minutes
+        FROM daily_stats d LEFT JOIN users u ON u.id = d.user_id
+        WHERE d.day >= ? AND d.day < ?"""
+    params = [rollup_day(start), rollup_day(end)]
+    if number_type:
+        sql += " AND d.type = ?"
+        params.append(number_type)
+    for day, username, user_id, row_type, added, taken, successful, blocked, dropped, removed, wait, hold in get_conn().execute(sql + " ORDER BY d.day, d.user_id", params):
+        yield [day, username or '', user_id, row_type, added, taken, successful, blocked, dropped, removed,
+               round(wait / taken, 1) if taken else '', round(hold / successful, 1) if successful else '']
+
+def write_hold_export(path, rows, fmt, header=EXPORT_HEADER):
+    count = 0
+    if fmt == 'xlsx':
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Табель")
+        ws.append(header)
+        for row in rows:
+            ws.append(row)
+            count += 1
+        wb.save(path)
+    else:
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(header)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    return count
+
+def _parse_export_date(text):
+    return tz.localize(datetime.strptime(text, '%Y-%m-%d'))
+
+def _parse_period(args):
+    # [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] -> [start, end); по умолчанию текущий месяц
+    today = datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = _parse_export_date(args[0]) if args else today.replace(day=1)
+    end = (_parse_export_date(args[1]) if len(args) > 1 else today) + timedelta(days=1)
+    return start, end
+
+@bot.message_handler(commands=['export'])
+def export_holds(message):
+    clear_pending_step(message.chat.id)
+    if not is_admin(message.from_user.id):
+        return
+    # /export [daily] [csv|xlsx] [с YYYY-MM-DD] [по YYYY-MM-DD] [vc|max]
+    args = message.text.split()[1:]
+    daily = bool(args) and args[0] == 'daily'
+    if daily:
+        args.pop(0)
+    fmt = args.pop(0) if args and args[0] in ('csv', 'xlsx') else 'csv'
+    number_type = args.pop() if args and args[-1] in ('vc', 'max') else None
+    try:
+        start, end = _parse_period(args)
+    except ValueError:
+        bot.send_message(message.chat.id, "Формат /export [daily] [csv|xlsx] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [vc|max]")
+        return
+    if fmt == 'xlsx' and Workbook is None:
+        bot.send_message(message.chat.id, "XLSX недоступен (нет openpyxl), выгружаю CSV")
+        fmt = 'csv'
+    file_name = f"{'daily' if daily else 'holds'}_{start:%Y-%m-%d}_{end - timedelta(days=1):%Y-%m-%d}{'_' + number_type if number_type else ''}.{fmt}"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, file_name)
+        if daily:
+            count = write_hold_export(path, iter_daily_rows(start, end, number_type), fmt, DAILY_EXPORT_HEADER)
+        else:
+            count = write_hold_export(path, iter_hold_rows(start, end, number_type), fmt)
+        with open(path, 'rb') as f:
+            bot.send_document(message.chat.id, f, caption=f"📊 {'Сводка по дням' if daily else 'Табель'}: {count} строк")
+    log_admin_action(message.from_user.id, f"Выгрузил табель {file_name}")
+
+# Расчёт выплат за период: неоплаченные холды грузятся колонками, выплата
+# по каждому считается по тарифу подписки на момент холда
+# (полные часы * ставка за час + ставка за 30 мин, если остаток >= 30 мин),
+# суммы по воркерам начисляются на balance одной транзакцией.
+SETTLE_CHUNK = 100000
+
+def _payout_rates():
+    tiers = [None] + list(config.SUBSCRIPTIONS)
+    return {tier: i for i, tier in enumerate(tiers)}, [get_price_increase(tier) for tier in tiers]
+
+PAYROLL_HOLDS_SQL = hot_query('payroll_holds', """
+    SELECT user_id, sub_type, hold_minutes
+    FROM numbers
+    WHERE state = 'successful' AND flight_time >= ? AND flight_time < ? AND settlement_id IS NULL AND hold_time IS NOT NULL AND hold_minutes IS NOT NULL""", ('', ''))
+
+def load_hold_columns(c, start, end):
+    tier_index, _ = _payout_rates()
+    user_ids, tiers, minutes = [], [], []
+    cur = c.execute(PAYROLL_HOLDS_SQL, (start, end))
+    while True:
+        rows = cur.fetchmany(SETTLE_CHUNK)
+        if not rows:
+            break
+        for user_id, sub_type, mins in rows:
+            user_ids.append(user_id)
+            tiers.append(tier_index.get(sub_type, 0))
+            minutes.append(mins)
+    return user_ids, tiers, minutes
+
+def compute_payouts(user_ids, tiers, minutes):
+    _, rates = _payout_rates()
+    if np is not None:
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        tiers = np.asarray(tiers, dtype=np.int64)
+        minutes = np.asarray(minutes, dtype=np.float64)
+        hour_rates = np.array([rate[0] for rate in rates], dtype=np.float64)
+        half_rates = np.array([rate[1] for rate in rates], dtype=np.float64)
+        amounts = np.floor(minutes / 60) * hour_rates[tiers] + (np.mod(minutes, 60) >= 30) * half_rates[tiers]
+        users, inverse = np.unique(user_ids, return_inverse=True)
+        totals = np.bincount(inverse, weights=amounts)
+        return {int(user_id): round(float(total), 2) for user_id, total in zip(users, totals)}
+    totals = {}
+    for user_id, tier, mins in zip(user_ids, tiers, minutes):
+        hour, half = rates[tier]
+        totals[user_id] = totals.get(user_id, 0) + (mins // 60) * hour + (half if mins % 60 >= 30 else 0)
+    return {user_id: round(total, 2) for user_id, total in totals.items()}
+
+def settle_payroll(start, end, admin_id=None):
+    # Под замком записи: набор строк между загрузкой и пометкой не меняется
+    now = datetime.now(tz)
+    with db_transaction() as c:
+        user_ids, tiers, minutes = load_hold_columns(c, start, end)
+        if not user_ids:
+            return None
+        payouts = compute_payouts(user_ids, tiers, minutes)
+        total = round(sum(payouts.values()), 2)
+        settlement_id = c.execute("INSERT INTO settlements (admin_id, period_start, period_end, holds_count, workers_count, total, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (admin_id, start, end, len(user_ids), len(payouts), total, now)).lastrowid
+        c.execute("UPDATE numbers SET settlement_id = ? WHERE state = 'successful' AND flight_time >= ? AND flight_time < ? AND settlement_id IS NULL AND hold_time IS NOT NULL AND hold_minutes IS NOT NULL", (settlement_id, start, end))
+        ledger_post_many(c, payouts, 'payroll', column='balance', contra=LEDGER_PAYROLL, now=now, txn_id=f"settlement:{settlement_id}")
+    return {'id': settlement_id, 'holds': len(user_ids), 'workers': len(payouts), 'total': total, 'payouts': payouts}
+
+@bot.message_handler(commands=['settle'])
+def settle(message):
+    clear_pending_step(message.chat.id)
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        start, end = _parse_period(message.text.split()[1:])
+    except ValueError:
+        bot.send_message(message.chat.id, "Формат /settle [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
+        return
+    try:
+        result = settle_payroll(start, end, message.from_user.id)
+    except LookupError as e:
+        # Транзакция откатилась целиком: холды остаются неоплаченными
+        print(f"Settlement {start} - {end} failed: {e}")
+        bot.send_message(message.chat.id, "❌ Выплата не проведена: часть воркеров не найдена в базе. Холды остались неоплаченными.")
+        return
+    if not result:
+        bot.send_message(message.chat.id, "Нет неоплаченных холдов за период")
+        return
+    for user_id, amount in result['payouts'].items():
+        if amount:
+            notify(user_id, f"💰 Начислено {amount}$ за холды")
+    bot.send_message(message.chat.id, f"Выплата #{result['id']}: холдов {result['holds']}, воркеров {result['workers']}, сумма {result['total']}$")
+    log_admin_action(message.from_user.id, f"Выплата #{result['id']} на {result['total']}$")
+
+@bot.message_handler(commands=['reconcile'])
+def reconcile(message):
+    clear_pending_step(message.chat.id)
+    if not is_admin(message.from_user.id):
+        return
+    mismatches = reconcile_balances()
+    if mismatches:
+        bot.send_message(message.chat.id, f"⚠️ Расхождений: {len(mismatches)}\n{format_mismatches(mismatches)}")
+    else:
+        bot.send_message(message.chat.id, "✅ Остатки сходятся с журналом")
+
+def _format_cache_stats(name, stats):
+    return f"{name}: {stats['hit_rate']:.1%} попаданий ({stats['hits']}/{stats['hits'] + stats['misses']}), в кэше {stats['size']}"
+
+@bot.message_handler(commands=['cache'])
+def cache_stats(message):
+    clear_pending_step(message.chat.id)
+    if not is_admin(message.from_user.id):
+        return
+    lines = [_format_cache_stats("Пользователи", user_cache_stats())]
+    membership = membership_cache_stats()
+    lines.append(_format_cache_stats("Подписки на каналы", membership) + f", ошибок Telegram {membership['errors']}")
+    bot.send_message(message.chat.id, "\n".join(lines))
+
+# Фото и файлы передаются только шагам, которые их ждут
+MEDIA_STEPS = ('process_add_number', 'process_add_image')
+
+@bot.message_handler(content_types=['photo', 'document'])
+def handle_pending_media(message):
+    chat_id = message.chat.id
+    step = pending_steps.get(chat_id)
+    if step and step[0].__name__ in MEDIA_STEPS:
+        handler, args = pending_steps.pop(chat_id)
+        handler(message, *args)
+
 @bot.message_handler(content_types=['text'])
 def handle_pending(message):
     chat_id = message.chat.id
@@ -1954,7 +4047,7 @@ def handle_pending(message):
 @bot.message_handler(commands=['hold'])
 def hold(message):
     clear_pending_step(message.chat.id)
-    successful = get_successful(message.chat.id)
+    successful = get_user_numbers(message.chat.id, 'successful')
     text = "\n".join(f"{item['phone_number']} ({item['type']}) холд: {item['hold_time']}" for item in successful if item['hold_time'])
     bot.send_message(message.chat.id, text or f"Нет холдов >= {MIN_HOLD_MINUTES} мин")
 
@@ -1965,9 +4058,19 @@ def del_number(message):
     if not phone:
         bot.send_message(message.chat.id, "Формат /del номер")
         return
-    cursor.execute("DELETE FROM queue WHERE phone_number = ? AND user_id = ?", (phone, message.chat.id))
-    conn.commit()
-    bot.send_message(message.chat.id, "Номер удален" if cursor.rowcount > 0 else "Номер не найден")
+    with db_transaction() as c:
+        # Удаляется ровно названный номер: тот же телефон, записанный иначе под другим типом, остаётся
+        rows = c.execute("SELECT id, type FROM numbers WHERE phone_key = ? AND phone_number = ? AND user_id = ? AND state = 'queued'", (normalize_phone(phone), phone, message.chat.id)).fetchall()
+        removed = [item_id for item_id, _ in rows]
+        now = datetime.now(tz)
+        c.executemany("UPDATE numbers SET state = 'removed', flight_time = ? WHERE id = ?", [(now, item_id) for item_id in removed])
+        for _, number_type in rows:
+            record_rollup(c, message.chat.id, number_type, 'removed', when=now)
+        deleted = len(removed)
+        if deleted:
+            note_queue_change(message.chat.id, -deleted)
+            db_after_commit(lambda: [queue_index.remove(item_id) for item_id in removed])
+    bot.send_message(message.chat.id, "Номер удален" if deleted > 0 else "Номер не найден")
     log_action(message.chat.id, f"Удалил номер {phone}")
 
 @bot.message_handler(commands=['menu'])
@@ -1975,29 +4078,104 @@ def menu(message):
     clear_pending_step(message.chat.id)
     show_main_menu(message.chat.id)
 
+# Инлайн-режим: Telegram присылает запрос на каждое нажатие клавиши, поэтому
+# превью ничего не пишет в БД. Каждый ответ получает свой код чека — он же id
+# результата; сам чек создаётся в chosen_inline_result, когда пользователь
+# отправил результат (нужен /setinlinefeedback в BotFather). Ответы кэшируются
+# Telegram для каждого пользователя отдельно, поэтому повторный запрос с той же
+# суммой до бота не доходит. Если из кэша один и тот же результат отправлен
+# дважды, второй раз выпускается новый чек и кнопка в отправленном сообщении
+# перенаправляется на него.
+INLINE_CACHE_TIME = 30  # секунды, с is_personal=True
+INLINE_PREVIEW_TTL = 10 * 60
+INLINE_PREVIEW_LIMIT = 10000
+
+_inline_previews = OrderedDict()  # unique_code -> (user_id, amount, expires_at)
+_inline_lock = threading.Lock()
+
+def _inline_preview_code(user_id, amount):
+    now = time.monotonic()
+    code = str(uuid.uuid4())
+    with _inline_lock:
+        _inline_previews[code] = (user_id, amount, now + INLINE_PREVIEW_TTL)
+        while _inline_previews:
+            oldest = next(iter(_inline_previews.values()))
+            if len(_inline_previews) <= INLINE_PREVIEW_LIMIT and oldest[2] > now:
+                break
+            _inline_previews.popitem(last=False)
+    return code
+
+def _take_inline_preview(code):
+    with _inline_lock:
+        return _inline_previews.pop(code, None)
+
+def _inline_amount(text):
+    text = text.strip()
+    return float(text) if text.replace('.', '', 1).isdigit() else None
+
+def _inline_check_markup(unique_code):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("Получить ✅", url=bot_link(f"check_{unique_code}")))
+    return markup
+
 @bot.inline_handler(func=lambda query: True)
 def inline_query(query):
-    if not query.query.replace('.', '', 1).isdigit():
+    amount = _inline_amount(query.query)
+    if amount is None:
         return
-    amount = float(query.query)
     user_id = query.from_user.id
     user = get_user(user_id)
     if not user or user['card_status'] != 'active' or amount < 1 or amount > user['card_balance']:
-        results = [types.InlineQueryResultArticle(id=str(uuid.uuid4()), title="❌ Недостаточно средств или карта не активна", input_message_content=types.InputTextMessageContent("❌ Ошибка создания чека."))]
-        bot.answer_inline_query(query.id, results)
+        results = [types.InlineQueryResultArticle(id="error", title="❌ Недостаточно средств или карта не активна", input_message_content=types.InputTextMessageContent("❌ Ошибка создания чека."))]
+        bot.answer_inline_query(query.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True)
         return
-    unique_code = str(uuid.uuid4())
-    cursor.execute("INSERT INTO checks (creator_id, amount, unique_code) VALUES (?, ?, ?)", (user_id, amount, unique_code))
-    conn.commit()
-    check_id = cursor.lastrowid
-    update_user(user_id, card_balance=user['card_balance'] - amount)
-    cursor.execute("INSERT INTO card_history (user_id, amount, timestamp, type) VALUES (?, ?, ?, ?)", (user_id, -amount, datetime.now(tz), 'check_create_inline'))
-    conn.commit()
-    link = f"https://t.me/{bot.get_me().username}?start=check_{unique_code}"
+    unique_code = _inline_preview_code(user_id, amount)
     caption = f"🦋 Чек на {amount} USDT 🪙"
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("Получить ✅", url=link))
-    results = [types.InlineQueryResultArticle(id=str(uuid.uuid4()), title=f"Чек на {amount} USDT", input_message_content=types.InputTextMessageContent(caption), reply_markup=markup)]
-    bot.answer_inline_query(query.id, results)
+    results = [types.InlineQueryResultArticle(id=unique_code, title=f"Чек на {amount} USDT", input_message_content=types.InputTextMessageContent(caption), reply_markup=_inline_check_markup(unique_code))]
+    bot.answer_inline_query(query.id, results, cache_time=INLINE_CACHE_TIME, is_personal=True)
 
-bot.infinity_polling()
\ No newline at end of file
+@bot.chosen_inline_handler(func=lambda result: True)
+def chosen_inline_result(result):
+    if result.result_id == "error":
+        return
+    user_id = result.from_user.id
+    unique_code = result.result_id
+    entry = _take_inline_preview(unique_code)
+    # После рестарта кэш пуст — сумму берём из текста запроса
+    amount = entry[1] if entry and entry[0] == user_id else _inline_amount(result.query)
+    if amount is None or amount < 1:
+        return
+    reissued = False
+    try:
+        with db_transaction() as c:
+            if c.execute("SELECT 1 FROM checks WHERE unique_code = ?", (unique_code,)).fetchone():
+                # Тот же результат отправлен повторно: по старой ссылке чек уже занят
+                unique_code = str(uuid.uuid4())
+                reissued = True
+            ledger_post(c, user_id, -amount, 'check_create_inline', contra=LEDGER_CHECKS)
+            c.execute("INSERT INTO checks (creator_id, amount, unique_code) VALUES (?, ?, ?)", (user_id, amount, unique_code))
+    except (InsufficientFunds, LookupError):
+        bot.send_message(user_id, f"❌ Чек на {amount} USDT не создан: недостаточно средств на карте.")
+        return
+    if reissued:
+        try:
+            bot.edit_message_reply_markup(inline_message_id=result.inline_message_id, reply_markup=_inline_check_markup(unique_code))
+        except Exception as e:
+            print(f"Inline check relink error: {e}")
+            bot.send_message(user_id, f"⚠️ Чек на {amount} USDT создан, но ссылку в сообщении обновить не удалось: {bot_link(f'check_{unique_code}')}")
+
+# Фоновые потоки и поллинг — только при запуске бота, не при импорте модуля (тесты)
+if __name__ == '__main__':
+    rebuild_queue_counters()
+    queue_index.rebuild()
+    start_audit_writer()
+    scheduler.load()
+    scheduler.start()
+    run_periodic(LEDGER_SNAPSHOT_INTERVAL, take_balance_snapshots, 'ledger-snapshots')
+    run_periodic(LEDGER_RECONCILE_INTERVAL, check_ledger, 'ledger-reconcile')
+    run_periodic(SWEEP_INTERVAL, run_sweeper, 'sweeper')
+    run_periodic(STATEMENT_INTERVAL, precompute_card_statements, 'card-statements')
+    try:
+        bot.infinity_polling()
+    finally:
+        stop_audit_writer()
@@ -0,0 +1,56 @@
+# Загрузка 1.py для нагрузочных прогонов: бот импортируется в пустом
+# временном каталоге (init_db создаёт новую bot.db), config и photos —
+# заглушки, а исходящие вызовы Telegram ничего не отправляют.
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+import telebot
+
+BOT_PATH = Path(__file__).resolve().parent.parent / '1.py'
+
+TELEGRAM_METHODS = ('send_message', 'send_photo', 'send_document', 'edit_message_caption', 'edit_message_media',
+                    'edit_message_reply_markup', 'answer_callback_query', 'answer_inline_query', 'get_chat_member')
+
+
+def load_bot():
+    os.chdir(tempfile.mkdtemp(prefix='bench-'))
+    config = types.ModuleType('config')
+    config.BOT_TOKEN = '123456:BENCH'
+    config.ADMIN_IDS = [1]
+    config.CHANNEL = '@bench'
+    config.CRYPTO_TOKEN = 'bench'
+    config.PRICES = {'hour': 4, '30min': 2}
+    config.SUBSCRIPTIONS = {}
+    photos = types.ModuleType('photos')
+    photos.PHOTOS = {}
+    sys.modules['config'] = config
+    sys.modules['photos'] = photos
+    telebot.TeleBot.get_me = lambda self: types.SimpleNamespace(id=1, username='bench_bot')
+    spec = importlib.util.spec_from_file_location('bot_bench', BOT_PATH)
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    for name in TELEGRAM_METHODS:
+        setattr(bot.bot, name, lambda *args, **kwargs: None)
+    return bot
+
+
+def add_users(bot, count, first_id=100, **columns):
+    names = ', '.join(columns)
+    rows = [(user_id, f'user{user_id}', f'ref_{user_id}', *columns.values()) for user_id in range(first_id, first_id + count)]
+    with bot.db_transaction() as c:
+        c.executemany(f"INSERT INTO users (id, username, referral_code{', ' if columns else ''}{names}) VALUES ({', '.join('?' * (3 + len(columns)))})", rows)
+    return [row[0] for row in rows]
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
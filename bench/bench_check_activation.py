@@ -0,0 +1,54 @@
+# Наплыв активаций одного чека: тысячи /start check_<код> из пула потоков
+# против чека с ограничением активаций. Активаций и начислений ровно столько,
+# сколько позволяет чек, повторная активация тем же пользователем не проходит,
+# журнал сходится с остатками.
+# Запуск: python bench/bench_check_activation.py [--hits 10000] [--limit 100] [--threads 64]
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from _bot import load_bot, add_users, Timer
+
+CREATOR_ID = 1
+AMOUNT = 2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hits', type=int, default=10000, help='разных пользователей')
+    parser.add_argument('--repeats', type=int, default=50, help='повторных переходов тех же пользователей')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=64)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    add_users(bot, 1, first_id=CREATOR_ID, card_status='active')
+    user_ids = add_users(bot, args.hits)
+    with bot.db_transaction() as c:
+        bot.ledger_post(c, CREATOR_ID, AMOUNT * args.limit, 'deposit')
+    bot.process_create_check(CREATOR_ID, AMOUNT, 1)
+    check_id, code = bot.db_fetchone("SELECT id, unique_code FROM checks WHERE creator_id = ?", (CREATOR_ID,))
+    bot.process_set_limit(SimpleNamespace(chat=SimpleNamespace(id=CREATOR_ID), text=str(args.limit)), check_id, 1)
+    assert bot.db_fetchone("SELECT activation_limit FROM checks WHERE id = ?", (check_id,))[0] == args.limit
+
+    def hit(user_id):
+        user = SimpleNamespace(id=user_id, username=f'user{user_id}', is_premium=False)
+        bot.handle_start(SimpleNamespace(chat=SimpleNamespace(id=user_id), from_user=user, text=f"/start check_{code}", message_id=1))
+
+    hits = user_ids + user_ids[:args.repeats]
+    with Timer() as timer:
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(hit, hits))
+
+    activations = bot.db_fetchone("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM check_activations WHERE check_id = ?", (check_id,))
+    count = bot.db_fetchone("SELECT activations_count FROM checks WHERE id = ?", (check_id,))[0]
+    credited = bot.db_fetchone("SELECT COUNT(*) FROM users WHERE id >= ? AND card_balance = ?", (user_ids[0], AMOUNT))[0]
+    assert activations == (args.limit, args.limit) and count == credited == args.limit, (activations, count, credited)
+    assert bot.get_user(CREATOR_ID)['card_balance'] == 0
+    assert bot.reconcile_balances() == []
+    print(f"{len(hits)} activation attempts from {args.threads} threads in {timer.elapsed:.2f}s "
+          f"({len(hits) / timer.elapsed:.0f}/s): {count} activations, {credited} credits; ledger reconciles")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Конкурентная выдача номеров: операторы одновременно забирают номера пачками
+# через claim_numbers. Ни один номер не достаётся двоим, счётчики очереди
+# совпадают с таблицей.
+# Запуск: python bench/bench_claim_contention.py [--claimers 32] [--batch 20]
+import argparse
+import threading
+from collections import Counter
+
+from _bot import load_bot, add_users, Timer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--claimers', type=int, default=32)
+    parser.add_argument('--batch', type=int, default=20)
+    parser.add_argument('--numbers', type=int, default=20000, help='поровну vc и max')
+    args = parser.parse_args()
+
+    bot = load_bot()
+    user_ids = add_users(bot, 100)
+    now = bot.datetime.now(bot.tz)
+    with bot.db_transaction() as c:
+        c.executemany("INSERT INTO numbers (user_id, phone_number, phone_key, type, state, added_time) VALUES (?, ?, ?, ?, 'queued', ?)",
+                      [(user_ids[i % len(user_ids)], f"9{i:09d}", f"9{i:09d}", 'vc' if i % 2 else 'max', now) for i in range(args.numbers)])
+    bot.queue_index.rebuild()
+    bot.rebuild_queue_counters()
+    expected = bot.db_fetchone("SELECT COUNT(*) FROM numbers WHERE type = 'vc'")[0]
+    claimed = [[] for _ in range(args.claimers)]
+
+    def claimer(n):
+        while True:
+            batch = bot.claim_numbers(n + 1, 'vc', args.batch)
+            if not batch:
+                return
+            claimed[n].extend(item['id'] for item in batch)
+
+    threads = [threading.Thread(target=claimer, args=(n,)) for n in range(args.claimers)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    ids = [item_id for batch in claimed for item_id in batch]
+    duplicates = [item_id for item_id, count in Counter(ids).items() if count > 1]
+    assert not duplicates, duplicates[:10]
+    assert len(ids) == expected, (len(ids), expected)
+    states = dict(bot.db_fetchall("SELECT state, COUNT(*) FROM numbers GROUP BY state"))
+    assert states.get('taken') == expected and states.get('queued') == args.numbers - expected, states
+    assert bot.queue_size() == states['queued'] == len(bot.queue_index)
+    print(f"{args.claimers} claimers took {len(ids)} numbers in batches of {args.batch} in {timer.elapsed:.2f}s "
+          f"({len(ids) / timer.elapsed:.0f}/s); no duplicates, counters match")
+
+
+if __name__ == '__main__':
+    main()
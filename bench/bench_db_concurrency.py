@@ -0,0 +1,111 @@
+# Параллельные get_user и update_user из пула потоков. По умолчанию — через
+# слой доступа бота (соединение на поток, WAL, один писатель под замком);
+# с --baseline — через прежнюю схему: одно соединение и один курсор на все
+# потоки (под замком — без него общий курсор роняет процесс). Каждый
+# писатель ведёт свою часть пользователей, поэтому в конце видно, потерялись
+# ли записи; читатели сверяют, что получили свою строку.
+# Запуск: python bench/bench_db_concurrency.py [--readers 8] [--writers 4] [--seconds 5] [--baseline] [--cache]
+import argparse
+import random
+import sqlite3
+import threading
+import time
+
+from _bot import load_bot, add_users
+
+
+def shared_connection_helpers(bot):
+    # Прежние get_user/update_user: общий курсор с check_same_thread=False и
+    # журнал без WAL, на копии той же базы. Замок — минимум, чтобы прогон
+    # дошёл до конца: любое обращение ждёт, пока закончится чужое.
+    target = sqlite3.connect('baseline.db')
+    bot.get_conn().backup(target)
+    target.execute("PRAGMA journal_mode=DELETE")
+    target.close()
+    conn = sqlite3.connect('baseline.db', check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+    cursor = conn.cursor()
+    lock = threading.Lock()
+
+    def get_user(user_id):
+        with lock:
+            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            row = cursor.fetchone()
+            if row:
+                columns = [desc[0] for desc in cursor.description]
+                return dict(zip(columns, row))
+            return None
+
+    def update_user(user_id, **kwargs):
+        set_clause = ', '.join(f"{k} = ?" for k in kwargs)
+        values = list(kwargs.values()) + [user_id]
+        with lock:
+            cursor.execute(f"UPDATE users SET {set_clause} WHERE id = ?", values)
+            conn.commit()
+
+    def reputations():
+        return dict(sqlite3.connect('baseline.db').execute("SELECT id, reputation FROM users").fetchall())
+
+    return get_user, update_user, reputations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--baseline', action='store_true', help='одно общее соединение, как до слоя доступа')
+    parser.add_argument('--cache', action='store_true', help='не отключать кэш get_user')
+    args = parser.parse_args()
+
+    bot = load_bot()
+    if not args.cache:
+        # Меряется хранилище, а не кэш: каждый get_user идёт в БД
+        bot.USER_CACHE_SIZE = 0
+    user_ids = add_users(bot, args.users, reputation=0)
+    if args.baseline:
+        get_user, update_user, reputations = shared_connection_helpers(bot)
+    else:
+        get_user, update_user = bot.get_user, bot.update_user
+        reputations = lambda: dict(bot.db_fetchall("SELECT id, reputation FROM users"))
+    deadline = time.monotonic() + args.seconds
+    reads, writes = [0] * args.readers, [0] * args.writers
+    wrong_rows = [0] * args.readers
+    written = {}
+
+    def reader(n):
+        while time.monotonic() < deadline:
+            user_id = random.choice(user_ids)
+            user = get_user(user_id)
+            if not user or user['id'] != user_id:
+                wrong_rows[n] += 1
+            reads[n] += 1
+
+    def writer(n):
+        own = user_ids[n::args.writers]
+        counts = dict.fromkeys(own, 0)
+        while time.monotonic() < deadline:
+            user_id = random.choice(own)
+            update_user(user_id, reputation=counts[user_id] + 1)
+            counts[user_id] += 1
+            writes[n] += 1
+        written.update(counts)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(args.readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stored = reputations()
+    lost = sum(1 for user_id, count in written.items() if stored[user_id] != count)
+    print(f"{'shared connection' if args.baseline else 'per-thread connections'}: "
+          f"{args.readers} readers {sum(reads) / args.seconds:.0f} get_user/s, "
+          f"{args.writers} writers {sum(writes) / args.seconds:.0f} update_user/s; "
+          f"wrong rows {sum(wrong_rows)}, users with lost updates {lost}")
+    assert not (sum(wrong_rows) or lost), (sum(wrong_rows), lost)
+
+
+if __name__ == '__main__':
+    main()
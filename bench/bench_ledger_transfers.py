@@ -0,0 +1,56 @@
+# Параллельные переводы между картами через ledger_transfer: сумма остатков
+# сохраняется, остатки не уходят в минус, журнал сходится с users.
+# Запуск: python bench/bench_ledger_transfers.py [--threads 16] [--transfers 500]
+import argparse
+import random
+import threading
+
+from _bot import load_bot, add_users, Timer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--transfers', type=int, default=500, help='переводов на поток')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--balance', type=float, default=100.0)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    user_ids = add_users(bot, args.users)
+    with bot.db_transaction() as c:
+        for user_id in user_ids:
+            bot.ledger_post(c, user_id, args.balance, 'deposit')
+    done, rejected = [0] * args.threads, [0] * args.threads
+
+    def worker(n):
+        rng = random.Random(n)
+        for _ in range(args.transfers):
+            from_user_id, to_user_id = rng.sample(user_ids, 2)
+            try:
+                with bot.db_transaction() as c:
+                    bot.ledger_transfer(c, from_user_id, to_user_id, rng.choice((1, 5, 20, 60)))
+                done[n] += 1
+            except bot.InsufficientFunds:
+                rejected[n] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.threads)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    total, lowest = bot.db_fetchone("SELECT SUM(card_balance), MIN(card_balance) FROM users")
+    assert abs(total - args.balance * args.users) < 1e-6, total
+    assert lowest >= 0, lowest
+    assert bot.db_fetchone("SELECT COUNT(*) FROM transfers")[0] == sum(done)
+    assert bot.reconcile_balances() == []
+    bot.take_balance_snapshots()
+    assert bot.reconcile_balances() == []
+    print(f"{args.threads} threads: {sum(done)} transfers, {sum(rejected)} rejected for funds, "
+          f"{timer.elapsed:.2f}s ({sum(done) / timer.elapsed:.0f}/s); ledger reconciles")
+
+
+if __name__ == '__main__':
+    main()
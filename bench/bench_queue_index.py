@@ -0,0 +1,71 @@
+# Индекс очереди на 100k номеров: сборка из БД, добавление, позиция номера,
+# первая страница, смена приоритета, выдача и удаление. Порядок после
+# сборки сверяется с полной сортировкой.
+# Запуск: python bench/bench_queue_index.py [--numbers 100000]
+import argparse
+import random
+from datetime import timedelta
+
+from _bot import load_bot, add_users, Timer
+
+SUBSCRIPTIONS = (None, 'Elite Access', 'Gold Tier', 'Prime Plus', 'VIP Nexus')
+
+
+def per_op(timer, count):
+    return f"{timer.elapsed / count * 1e6:.1f}us"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--numbers', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=5000)
+    args = parser.parse_args()
+
+    bot = load_bot()
+    rng = random.Random(1)
+    user_ids = add_users(bot, args.users)
+    with bot.db_transaction() as c:
+        c.executemany("UPDATE users SET subscription_type = ?, reputation = ? WHERE id = ?",
+                      [(rng.choice(SUBSCRIPTIONS), rng.randint(0, 30), user_id) for user_id in user_ids])
+        now = bot.datetime.now(bot.tz)
+        c.executemany("INSERT INTO numbers (user_id, phone_number, phone_key, type, state, added_time) VALUES (?, ?, ?, ?, 'queued', ?)",
+                      [(rng.choice(user_ids), f"9{i:09d}", f"9{i:09d}", rng.choice(('vc', 'max')), now + timedelta(seconds=i))
+                       for i in range(args.numbers)])
+
+    index = bot.QueueIndex()
+    with Timer() as rebuild:
+        index.rebuild()
+    users = {row[0]: row[1:] for row in bot.db_fetchall("SELECT id, subscription_type, reputation FROM users")}
+    rows = bot.db_fetchall("SELECT id, user_id, added_time FROM numbers")
+    expected = [row[0] for row in sorted(rows, key=lambda r: (-bot.SUBSCRIPTION_PRIORITY.get(users[r[1]][0], 0), -users[r[1]][1], r[2], r[0]))]
+    assert [key[-1] for key in index.page(len(rows))] == expected
+
+    index = bot.QueueIndex()
+    with Timer() as add:
+        for item_id, user_id, added_time in rows:
+            index.add(item_id, user_id, rng.choice(('vc', 'max')), added_time, *users[user_id])
+    samples = rng.sample([row[0] for row in rows], 10000)
+    with Timer() as rank:
+        for item_id in samples:
+            index.rank(item_id)
+    with Timer() as page:
+        for _ in range(1000):
+            index.page(bot.PAGE_SIZE)
+    with Timer() as reprioritize:
+        for user_id in user_ids[:200]:
+            index.reprioritize(user_id, 'VIP Nexus', 50)
+    with Timer() as pop:
+        for _ in range(1000):
+            index.pop('vc', 10)
+    remaining = [item_id for item_id in samples if index.rank(item_id) is not None]
+    with Timer() as remove:
+        for item_id in remaining:
+            index.remove(item_id)
+
+    print(f"{args.numbers} numbers: rebuild {rebuild.elapsed:.2f}s, add {per_op(add, len(rows))}, rank {per_op(rank, len(samples))}, "
+          f"page {per_op(page, 1000)}, reprioritize {per_op(reprioritize, 200)} per user, pop(10) {per_op(pop, 1000)}, "
+          f"remove {per_op(remove, len(remaining))}; order matches a full sort")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import importlib.util
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+BOT_PATH = Path(__file__).resolve().parent.parent / '1.py'
+
+
+@pytest.fixture
+def bot_module(tmp_path, monkeypatch):
+    # Модуль бота импортируется в пустом каталоге: init_db() прогоняет все
+    # миграции на новой bot.db, а Telegram не вызывается
+    monkeypatch.chdir(tmp_path)
+    config = types.ModuleType('config')
+    config.BOT_TOKEN = '123456:TEST'
+    config.ADMIN_IDS = [1]
+    config.CHANNEL = '@test'
+    config.CRYPTO_TOKEN = 'test'
+    config.PRICES = {'hour': 4, '30min': 2}
+    config.SUBSCRIPTIONS = {}
+    photos = types.ModuleType('photos')
+    photos.PHOTOS = {}
+    monkeypatch.setitem(sys.modules, 'config', config)
+    monkeypatch.setitem(sys.modules, 'photos', photos)
+    telebot = pytest.importorskip('telebot')
+    monkeypatch.setattr(telebot.TeleBot, 'get_me', lambda self: types.SimpleNamespace(id=1, username='test_bot'), raising=False)
+    spec = importlib.util.spec_from_file_location('bot_under_test', BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
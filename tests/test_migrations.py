@@ -0,0 +1,34 @@
+import pytest
+
+pytest.importorskip('telebot')
+pytest.importorskip('pytz')
+pytest.importorskip('requests')
+
+
+def test_migrations_reach_latest_version(bot_module):
+    target = max(version for version, _ in bot_module.SCHEMA_MIGRATIONS)
+    assert bot_module.db_fetchone("PRAGMA user_version")[0] == target
+
+
+def test_numbers_registry_drops_colliding_working_rows(bot_module, monkeypatch):
+    # База до миграции 11: в работе один номер записан в двух видах, и он же
+    # стоит в очереди
+    monkeypatch.setattr(bot_module, 'DB_PATH', 'legacy.db')
+    monkeypatch.setattr(bot_module._db_local, 'conn', None)
+    c = bot_module._db_connect()
+    for version, func in sorted(bot_module.SCHEMA_MIGRATIONS, key=lambda m: m[0]):
+        if version < 11:
+            func(c)
+    c.execute("PRAGMA user_version = 10")
+    c.executemany("INSERT INTO working (id, user_id, phone_number, type, status) VALUES (?, ?, ?, ?, ?)",
+                  [(1, 5, '+79991112233', 'vc', 'accepted'), (2, 6, '9991112233', 'vc', 'taken'), (3, 7, '89991112233', 'max', 'taken')])
+    c.execute("INSERT INTO queue (user_id, phone_number, type) VALUES (8, '79991112233', 'vc')")
+    c.close()
+
+    bot_module.init_db()
+
+    assert bot_module.db_fetchall("SELECT id, user_id, phone_key, type, state FROM numbers ORDER BY id") == [
+        (1, 5, '9991112233', 'vc', 'accepted'),
+        (2, 6, '9991112233', 'vc', 'dropped'),
+        (3, 7, '9991112233', 'max', 'taken'),
+    ]
@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip('telebot')
+pytest.importorskip('pytz')
+pytest.importorskip('requests')
+
+
+def test_hot_queries_execute(bot_module):
+    for name, sql, params in bot_module.HOT_QUERIES:
+        bot_module.db_fetchall(sql, params)
+
+
+def test_hot_queries_do_not_scan_tables(bot_module):
+    assert bot_module.find_full_scans() == []